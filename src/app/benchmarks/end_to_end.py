@@ -0,0 +1,257 @@
+# End-to-end benchmark of the bot against local fakes of Telegram, Gemini
+# and Supabase. No network access or credentials are needed.
+#
+# Usage, from src/app:
+#   python -m benchmarks.end_to_end --users 50 --receipts 2 --gemini-latency 3 --output results.json
+#
+# Every simulated user greets the bot, taps "Subir boleta", sends a photo,
+# waits for the confirmation and taps "Aceptar", --receipts times. The
+# updates go through the same handlers, update processor and receipt queue
+# as in production. The report has p50/p95/p99 of each interaction and of
+# each stage of a receipt, plus receipts per second, as JSON.
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from aiohttp import web
+from benchmarks.fakes import FakeGemini, FakeTelegramRequest, create_fake_supabase, receipt_photo
+from benchmarks.stats import latency_summary
+
+APP_DIR = Path(__file__).resolve().parent.parent
+BOT_SCRIPT = APP_DIR / "chatbot-telegram.py"
+FIRST_CHAT_ID = 100000
+
+
+def load_bot():
+    # The script name has a dash, so it is loaded by path
+    spec = importlib.util.spec_from_file_location("chatbot_telegram", BOT_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"}
+
+
+def chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "private"}
+
+
+class Replies:
+    # Resolves a future when the fake Telegram receives the expected call for a chat
+    def __init__(self):
+        self._waiters = defaultdict(list)
+
+    def expect(self, chat_id: int, matches) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((matches, future))
+        return future
+
+    def on_request(self, method: str, params: dict, received_at: float) -> None:
+        if "chat_id" not in params:
+            return
+        waiters = self._waiters[int(params["chat_id"])]
+        for waiter in list(waiters):
+            matches, future = waiter
+            if not future.done() and matches(method, params):
+                future.set_result(received_at)
+                waiters.remove(waiter)
+
+
+def is_confirmation(method: str, params: dict) -> bool:
+    return "confirm-invoice" in json.dumps(params.get("reply_markup") or {})
+
+
+def is_progress(method: str, params: dict) -> bool:
+    return method == "editMessageText" and not params.get("reply_markup")
+
+
+def is_message(method: str, params: dict) -> bool:
+    return method == "sendMessage"
+
+
+def timed(name: str, function, stages: dict):
+    # Wraps a function of the bot to record how long each call takes
+    if asyncio.iscoroutinefunction(function):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                stages[name].append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stages[name].append(time.perf_counter() - start)
+    return wrapper
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="kooko-e2e-")
+    # Read by the functions modules when the bot is imported below
+    os.environ.update({
+        "SUPABASE_URL": f"http://127.0.0.1:{args.supabase_port}",
+        "SUPABASE_ANON_KEY": "bench.mark.key",
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.sqlite3"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "JOB_QUEUE_MAX_PENDING": str(args.users * args.receipts + 1),
+        "CREDITS_SPOOL_PATH": os.path.join(workdir, "credits_spool.jsonl"),
+        "RECEIPT_WORKERS": str(args.receipt_workers),
+        "RECEIPT_CONCURRENCY": str(args.receipt_concurrency),
+        "GEMINI_STREAMING": "true" if args.streaming else "false",
+    })
+    bot_module = load_bot()
+    # Imported by the bot with the environment above
+    import functions.invoice
+    stages = defaultdict(list)
+    for name in ("normalize_image", "invoice_processing", "save_invoices"):
+        setattr(bot_module, name, timed(name, getattr(bot_module, name), stages))
+    gemini = FakeGemini(
+        latency=args.gemini_latency,
+        products=args.products,
+        image_tokens=args.image_tokens,
+        text_tokens=args.text_tokens,
+        output_tokens=args.output_tokens,
+    )
+    functions.invoice._gemini_client = gemini
+
+    supabase_calls = []
+    supabase = web.AppRunner(create_fake_supabase(args.supabase_latency, supabase_calls))
+    await supabase.setup()
+    await web.TCPSite(supabase, "127.0.0.1", args.supabase_port).start()
+
+    chat_ids = range(FIRST_CHAT_ID, FIRST_CHAT_ID + args.users)
+    files = {
+        f"photo-{chat_id}-{index}": receipt_photo(chat_id * 1000 + index)
+        for chat_id in chat_ids
+        for index in range(args.receipts)
+    }
+    replies = Replies()
+    request = FakeTelegramRequest(files, replies.on_request)
+    application = (
+        bot_module.Application.builder()
+        .token("123456:benchmark")
+        .request(request)
+        .get_updates_request(FakeTelegramRequest())
+        .concurrent_updates(bot_module.ChatOrderedUpdateProcessor(bot_module.UPDATE_CONCURRENCY))
+        .build()
+    )
+    bot_module.add_handlers(application)
+    await application.initialize()
+    await bot_module.post_init(application)
+    await application.start()
+
+    latencies = defaultdict(list)
+    errors = 0
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def send(chat_id: int, update: dict, matches, name: str) -> None:
+        reply = replies.expect(chat_id, matches)
+        start = time.perf_counter()
+        await application.update_queue.put(bot_module.Update.de_json({"update_id": next(update_ids), **update}, application.bot))
+        latencies[name].append(await asyncio.wait_for(reply, args.timeout) - start)
+
+    def message(chat_id: int, **content) -> dict:
+        return {"message": {"message_id": next(update_ids), "date": int(time.time()), "chat": chat(chat_id), "from": user(chat_id), **content}}
+
+    def callback(chat_id: int, data: str) -> dict:
+        return {"callback_query": {
+            "id": str(next(update_ids)),
+            "from": user(chat_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat(chat_id), "text": "menu"},
+        }}
+
+    async def simulate(chat_id: int) -> None:
+        nonlocal errors
+        # A registered user, as if they had shared their phone before
+        application.user_data[chat_id]["user_phone"] = f"+51{chat_id}"
+        try:
+            await send(chat_id, message(chat_id, text="hola"), is_message, "text")
+            for index in range(args.receipts):
+                await send(chat_id, callback(chat_id, "upload-invoice"), is_message, "button")
+                first_progress = replies.expect(chat_id, is_progress)
+                start = time.perf_counter()
+                photo = {"file_id": f"photo-{chat_id}-{index}", "file_unique_id": f"photo-{chat_id}-{index}", "width": 960, "height": 1280}
+                await send(chat_id, message(chat_id, photo=[photo]), is_confirmation, "receipt")
+                if first_progress.done():
+                    latencies["first_progress"].append(first_progress.result() - start)
+                else:
+                    first_progress.cancel()
+                await send(chat_id, callback(chat_id, "confirm-invoice"), is_message, "button")
+        except asyncio.TimeoutError:
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate(chat_id) for chat_id in chat_ids))
+    elapsed = time.perf_counter() - start
+
+    await application.stop()
+    await bot_module.post_stop(application)
+    await application.shutdown()
+    await bot_module.post_shutdown(application)
+    await supabase.cleanup()
+    receipts = len(latencies["receipt"])
+    return {
+        "commit": git_commit(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "supabase_port")
+        },
+        "seconds": elapsed,
+        "receipts": receipts,
+        "receipts_per_second": receipts / elapsed if elapsed else 0.0,
+        "errors": errors,
+        "gemini_calls": gemini.calls,
+        "supabase_requests": len(supabase_calls),
+        "latency": {name: latency_summary(values) for name, values in latencies.items()},
+        "stages": {name: latency_summary(values) for name, values in stages.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the bot against local fakes")
+    parser.add_argument("--users", type=int, default=20, help="Users talking to the bot at the same time")
+    parser.add_argument("--receipts", type=int, default=2, help="Receipts sent by each user")
+    parser.add_argument("--gemini-latency", type=float, default=2.0, help="Seconds Gemini takes to answer")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--products", type=int, default=8, help="Products in each answer of Gemini")
+    parser.add_argument("--image-tokens", type=int, default=258)
+    parser.add_argument("--text-tokens", type=int, default=40)
+    parser.add_argument("--output-tokens", type=int, default=400)
+    parser.add_argument("--supabase-latency", type=float, default=0.05, help="Seconds every Supabase request takes")
+    parser.add_argument("--supabase-port", type=int, default=8478)
+    parser.add_argument("--receipt-workers", type=int, default=4)
+    parser.add_argument("--receipt-concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for a reply before counting an error")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
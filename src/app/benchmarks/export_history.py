@@ -0,0 +1,96 @@
+# Benchmark of /export against a fake Supabase with a large history.
+#
+# Usage, from src/app:
+#   python -m benchmarks.export_history --receipts 50000 --products 5 --format csv
+#
+# The fake Supabase makes up --receipts invoices of --products products for
+# the user, so the history costs no memory on its side. The report has the
+# time of the export, rows per second and the files it wrote, as JSON. With
+# --memory it also has the peak of Python memory during the export, which
+# should not grow with --receipts (tracing makes the export slower).
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from aiohttp import web
+from benchmarks.end_to_end import git_commit
+from benchmarks.fakes import create_fake_supabase
+
+
+async def run(args) -> dict:
+    # Read by the functions modules when they are imported below
+    os.environ.update({
+        "SUPABASE_URL": f"http://127.0.0.1:{args.supabase_port}",
+        "SUPABASE_ANON_KEY": "bench.mark.key",
+        "EXPORT_PAGE_SIZE": str(args.page_size),
+        "EXPORT_MAX_FILE_BYTES": str(int(args.max_file_mb * 1024 * 1024)),
+        "METRICS_PORT": "0",
+    })
+    from functions.export import InvoiceExport
+    from functions.supabase import close_supabase_client
+
+    calls = []
+    supabase = web.AppRunner(create_fake_supabase(args.supabase_latency, calls, args.receipts, args.products))
+    await supabase.setup()
+    await web.TCPSite(supabase, "127.0.0.1", args.supabase_port).start()
+
+    files = {}
+    with tempfile.TemporaryDirectory(prefix="kooko-export-") as directory:
+        export = InvoiceExport("user-benchmark", args.format, directory)
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        first_file = None
+        async for path in export.files():
+            first_file = first_file or time.perf_counter() - start
+            files[path.name] = path.stat().st_size
+            # As the bot does once a file is sent
+            path.unlink()
+        elapsed = time.perf_counter() - start
+        peak = None
+        if args.memory:
+            peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+
+    await close_supabase_client()
+    await supabase.cleanup()
+    rows = export.invoices.rows + export.products.rows
+    return {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "supabase_port")},
+        "seconds": elapsed,
+        "first_file_seconds": first_file,
+        "invoices": export.invoices.rows,
+        "products": export.products.rows,
+        "rows_per_second": rows / elapsed if elapsed else 0.0,
+        "supabase_requests": len(calls),
+        "peak_python_mb": peak,
+        "files": files,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the invoice export against a fake Supabase")
+    parser.add_argument("--receipts", type=int, default=20000, help="Invoices in the history of the user")
+    parser.add_argument("--products", type=int, default=5, help="Products of each invoice")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--max-file-mb", type=float, default=45)
+    parser.add_argument("--memory", action="store_true", help="Trace the peak of Python memory")
+    parser.add_argument("--supabase-latency", type=float, default=0.02, help="Seconds every Supabase request takes")
+    parser.add_argument("--supabase-port", type=int, default=8481)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
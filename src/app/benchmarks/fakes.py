@@ -0,0 +1,302 @@
+# Local stand-ins for the external services, so benchmarks never reach them.
+import asyncio
+import io
+import itertools
+import json
+import random
+import time
+from types import SimpleNamespace
+from aiohttp import web
+from google.genai import types
+from PIL import Image, ImageDraw, ImageFont
+from telegram.request import BaseRequest
+
+
+def create_fake_bot_api(on_request=None) -> web.Application:
+    # Answers the Bot API methods the bot uses. Point TELEGRAM_BASE_URL (or
+    # ApplicationBuilder.base_url) at it. on_request(method, params, received_at)
+    # is called for every call so the benchmark can measure replies.
+    message_ids = itertools.count(1)
+
+    def message(params: dict) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def call(request: web.Request) -> web.Response:
+        received_at = time.perf_counter()
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if on_request is not None:
+            on_request(method, params, received_at)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "kooko", "username": "kooko_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = message(params)
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", call)
+    return app
+
+
+def receipt_photo(seed: int, size: tuple = (960, 1280)) -> bytes:
+    # A light receipt with seeded lines of text on a dark table, different for
+    # every seed so the OCR cache never answers in place of Gemini.
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, (70, 60, 50))
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    draw.rectangle([width // 6, height // 20, width * 5 // 6, height * 19 // 20], fill=(245, 244, 238))
+    for y in range(height // 20 + 30, height * 19 // 20 - 30, 28):
+        draw.text((width // 6 + 30, y), f"PRODUCTO {rng.randint(1, 9999):04d}   S/ {rng.uniform(1, 99):6.2f}", fill=(20, 20, 20))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def receipt_screenshot(seed: int, size: tuple = (1080, 2400)) -> bytes:
+    # A phone screenshot of an electronic receipt: a few seeded lines of text
+    # on a white background, as Telegram sends it when shared as a photo
+    rng = random.Random(seed)
+    font_size = rng.randint(24, 40)
+    image = Image.new("RGB", size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.text((60, 80), "BOLETA DE VENTA ELECTRÓNICA", fill=(0, 0, 0), font=ImageFont.load_default(size=font_size + 8))
+    font = ImageFont.load_default(size=font_size)
+    for line in range(rng.randint(6, 30)):
+        draw.text(
+            (60, 200 + line * font_size * 2),
+            f"PRODUCTO {rng.randint(1, 9999):04d}   S/ {rng.uniform(1, 99):6.2f}",
+            fill=(30, 30, 30),
+            font=font,
+        )
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+class FakeTelegramRequest(BaseRequest):
+    # In-process Bot API for Application.builder().request(...). Photos are
+    # served from the files dict (file_id -> bytes) and every call is passed
+    # to on_request(method, params, received_at).
+    def __init__(self, files: dict = None, on_request=None):
+        self.files = files if files is not None else {}
+        self.on_request = on_request
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return 10
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        received_at = time.perf_counter()
+        if "/file/bot" in url:
+            file_id = url.rsplit("/", 1)[1].removesuffix(".jpg")
+            return 200, self.files[file_id]
+        name = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        if self.on_request is not None:
+            self.on_request(name, params, received_at)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "kooko", "username": "kooko_bot"}
+        elif name == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        elif name in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def fake_invoice(products: int) -> dict:
+    return {
+        "id_invoice": "F001-00012345",
+        "date": "2025-01-02",
+        "time": "12:30:00",
+        "payment_date": "2025-01-02",
+        "currency_type": "PEN",
+        "category_type": "ALIMENTACIÓN",
+        "payment_method": "EFECTIVO",
+        "seller": {"id_seller": "20123456789", "name_seller": "Bodega Kooko"},
+        "client": {"id_client": "12345678", "name_client": "Cliente", "address": None},
+        "products": [
+            {"product_name": f"Producto {index}", "unit_price": 1.5 + index, "quantity": 1 + index % 3}
+            for index in range(products)
+        ],
+        "taxes": {
+            "recorded_operation": 10.0, "igv": 1.8, "isc": None, "unaffected": None, "exonerated": None,
+            "export": None, "free": None, "discount": None, "others_charge": None, "others_taxes": None,
+        },
+    }
+
+
+class FakeGemini:
+    # Stands in for genai.Client: answers after `latency` seconds (spread over
+    # the chunks when streaming) with a fixed invoice and the given token usage.
+    def __init__(self, latency: float, products: int, image_tokens: int, text_tokens: int, output_tokens: int, chunks: int = 12):
+        self.latency = latency
+        self.text = json.dumps(fake_invoice(products))
+        self.usage = types.GenerateContentResponseUsageMetadata(
+            prompt_tokens_details=[
+                types.ModalityTokenCount(modality=types.MediaModality.TEXT, token_count=text_tokens),
+                types.ModalityTokenCount(modality=types.MediaModality.IMAGE, token_count=image_tokens),
+            ],
+            candidates_token_count=output_tokens,
+        )
+        self.chunks = chunks
+        self.calls = 0
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(
+                generate_content=self.generate_content,
+                generate_content_stream=self.generate_content_stream,
+            ),
+            caches=SimpleNamespace(create=self.create_cache),
+        )
+
+    def response(self, text: str, usage=None) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=usage,
+        )
+
+    async def create_cache(self, model, config):
+        return SimpleNamespace(name="cachedContents/benchmark")
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.response(self.text, self.usage)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.calls += 1
+        size = -(-len(self.text) // self.chunks)
+
+        async def chunks():
+            for start in range(0, len(self.text), size):
+                await asyncio.sleep(self.latency / self.chunks)
+                last = start + size >= len(self.text)
+                yield self.response(self.text[start:start + size], self.usage if last else None)
+        return chunks()
+
+
+def history_invoice(invoice_id: int) -> dict:
+    # Synthetic invoice of the read endpoints, spread over categories and months
+    return {
+        "id": invoice_id,
+        "id_invoice": f"F001-{invoice_id}",
+        "date": f"{2024 + invoice_id % 2}-{invoice_id % 12 + 1:02d}-15",
+        "time": "12:00:00",
+        "payment_date": "",
+        "payment_method": "EFECTIVO",
+        "currency_type": "USD" if invoice_id % 10 == 0 else "PEN",
+        "category_type": ("ALIMENTOS", "TRANSPORTE", "SERVICIOS", "OTROS")[invoice_id % 4],
+        "id_seller": "20123456789",
+        "name_seller": "Tienda de prueba",
+        "id_client": "",
+        "name_client": "",
+        "address": "",
+        "total": 10.0 + invoice_id % 7,
+        "recorded_operation": 10.0 + invoice_id % 7,
+        "igv": 1.8,
+        "isc": 0,
+        "unaffected": 0,
+        "exonerated": 0,
+        "export": 0,
+        "free": 0,
+        "discount": 0,
+        "others_charge": 0,
+        "others_taxes": 0,
+        "path_file": f"public/user-{invoice_id}.jpg",
+    }
+
+
+def history_details(invoice_id: int, products: int) -> list:
+    return [
+        {
+            "id": (invoice_id - 1) * products + index + 1,
+            "invoice": invoice_id,
+            "id_invoice": f"F001-{invoice_id}",
+            "product_name": f"Producto {index + 1}",
+            "unit_price": 1.0 + index,
+            "quantity": 1.0,
+        }
+        for index in range(products)
+    ]
+
+
+def create_fake_supabase(latency: float = 0.0, calls: list = None, history: int = 0, products: int = 5) -> web.Application:
+    # PostgREST and Storage endpoints used by functions.supabase. Every
+    # request waits `latency` seconds and is appended to calls. Every user
+    # has `history` invoices of `products` products to read, made up on the
+    # fly so a large history costs no memory.
+    invoice_ids = itertools.count(1)
+
+    async def rest(request: web.Request) -> web.Response:
+        body = await request.read()
+        if calls is not None:
+            calls.append((request.method, request.path, len(body)))
+        await asyncio.sleep(latency)
+        table = request.match_info["tail"]
+        if table == "users":
+            phone = request.query.get("user_phone", "eq.0").removeprefix("eq.")
+            return web.json_response([{"user_id": f"user-{phone}"}])
+        if table == "rpc/insert_invoices":
+            items = json.loads(body)["p_invoices"]
+            return web.json_response([
+                {"invoice": next(invoice_ids), "details": [], "credits": None} for _ in items
+            ])
+        if table.startswith("rpc/"):
+            return web.json_response(None)
+        after_id = int(request.query.get("id", "gt.0").removeprefix("gt."))
+        limit = int(request.query.get("limit", "1000"))
+        if table == "invoices" and request.method == "GET":
+            return web.json_response([
+                history_invoice(invoice_id)
+                for invoice_id in range(after_id + 1, min(history, after_id + limit) + 1)
+            ])
+        if table == "invoices_detail" and request.method == "GET":
+            owners = request.query.get("invoice", "in.()").removeprefix("in.(").removesuffix(")")
+            rows = [
+                row
+                for invoice_id in sorted(int(owner) for owner in owners.split(",") if owner)
+                for row in history_details(invoice_id, products)
+                if row["id"] > after_id
+            ]
+            return web.json_response(rows[:limit])
+        if request.method == "POST":
+            return web.Response(status=201)
+        return web.json_response([])
+
+    async def storage(request: web.Request) -> web.Response:
+        body = await request.read()
+        if calls is not None:
+            calls.append((request.method, request.path, len(body)))
+        await asyncio.sleep(latency)
+        path = request.match_info["tail"]
+        return web.json_response({"Key": path, "Id": path})
+
+    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app.router.add_route("*", "/rest/v1/{tail:.*}", rest)
+    app.router.add_route("*", "/storage/v1/{tail:.*}", storage)
+    return app
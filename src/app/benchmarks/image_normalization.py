@@ -0,0 +1,129 @@
+# Compares the photo as Telegram delivers it against the normalized copy.
+#
+# Usage, from src/app:
+#   python -m benchmarks.image_normalization path/to/receipts
+#   python -m benchmarks.image_normalization path/to/receipts --gemini --json
+#
+# Without --gemini the image tokens are estimated with the tiling rule of
+# Gemini 2.0 (258 tokens per 768x768 tile), so no API key is needed. With
+# --gemini every fixture is sent twice through invoice_processing and the
+# real token counts and latencies are reported.
+#
+# --synthetic COUNT first writes COUNT made-up receipt photos to the directory
+# to try the script without real photos. They are flat and easy to compress,
+# so their sizes say little about real ones.
+import argparse
+import asyncio
+import io
+import json
+import math
+import statistics
+import time
+from pathlib import Path
+from PIL import Image
+from functions.image import normalize_image
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+# Compressed photos (up to 1280 px) and photos sent as files (larger)
+SYNTHETIC_SIZES = ((960, 1280), (1280, 960), (720, 1280), (1536, 2048), (3000, 4000))
+
+
+def estimate_image_tokens(image_bytes: bytes) -> int:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        width, height = image.size
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+async def measure_gemini(image_bytes: bytes) -> dict:
+    from functions.invoice import invoice_processing
+    start = time.perf_counter()
+    result = await invoice_processing(image_bytes=image_bytes)
+    return {
+        "latency": time.perf_counter() - start,
+        "token_image": result["input"]["token_image"],
+        "token_text": result["input"]["token_text"] + result["output"]["token_text"],
+    }
+
+
+def write_synthetic(directory: Path, count: int) -> None:
+    from benchmarks.fakes import receipt_photo
+    directory.mkdir(parents=True, exist_ok=True)
+    for seed in range(count):
+        size = SYNTHETIC_SIZES[seed % len(SYNTHETIC_SIZES)]
+        (directory / f"synthetic-{seed}.jpg").write_bytes(receipt_photo(seed, size))
+
+
+async def run(fixtures: Path, use_gemini: bool) -> list:
+    rows = []
+    for path in sorted(fixtures.iterdir()):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        raw = path.read_bytes()
+        start = time.perf_counter()
+        ocr_bytes, archive_bytes = normalize_image(raw)
+        row = {
+            "file": path.name,
+            "normalize_seconds": time.perf_counter() - start,
+            "raw_bytes": len(raw),
+            "ocr_bytes": len(ocr_bytes),
+            "archive_bytes": len(archive_bytes),
+            "raw_tokens_estimate": estimate_image_tokens(raw),
+            "ocr_tokens_estimate": estimate_image_tokens(ocr_bytes),
+        }
+        if use_gemini:
+            row["raw_gemini"] = await measure_gemini(raw)
+            row["ocr_gemini"] = await measure_gemini(ocr_bytes)
+        rows.append(row)
+    return rows
+
+
+def summarize(rows: list) -> dict:
+    summary = {
+        "fixtures": len(rows),
+        "normalize_seconds_p50": statistics.median(row["normalize_seconds"] for row in rows),
+        "raw_bytes_total": sum(row["raw_bytes"] for row in rows),
+        "ocr_bytes_total": sum(row["ocr_bytes"] for row in rows),
+        "archive_bytes_total": sum(row["archive_bytes"] for row in rows),
+        "raw_tokens_estimate_total": sum(row["raw_tokens_estimate"] for row in rows),
+        "ocr_tokens_estimate_total": sum(row["ocr_tokens_estimate"] for row in rows),
+    }
+    if rows and "raw_gemini" in rows[0]:
+        for variant in ("raw", "ocr"):
+            results = [row[f"{variant}_gemini"] for row in rows]
+            summary[f"{variant}_token_image_total"] = sum(r["token_image"] for r in results)
+            summary[f"{variant}_token_text_total"] = sum(r["token_text"] for r in results)
+            summary[f"{variant}_latency_p50"] = statistics.median(r["latency"] for r in results)
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the image normalization stage")
+    parser.add_argument("fixtures", type=Path, help="Directory with receipt photos")
+    parser.add_argument("--gemini", action="store_true", help="Call Gemini to measure real tokens and latency")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+    parser.add_argument("--synthetic", type=int, metavar="COUNT", help="First write COUNT synthetic photos to the directory")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        write_synthetic(args.fixtures, args.synthetic)
+    rows = asyncio.run(run(args.fixtures, args.gemini))
+    if not rows:
+        parser.error(f"No images found in {args.fixtures}")
+    summary = summarize(rows)
+    if args.json:
+        print(json.dumps({"rows": rows, "summary": summary}, indent=2))
+        return
+    for row in rows:
+        print(
+            f"{row['file']}: {row['raw_bytes']:,} B -> {row['ocr_bytes']:,} B, "
+            f"~{row['raw_tokens_estimate']} -> ~{row['ocr_tokens_estimate']} image tokens, "
+            f"{row['normalize_seconds'] * 1000:.1f} ms"
+        )
+    for key, value in summary.items():
+        print(f"{key}: {value:,.3f}" if isinstance(value, float) else f"{key}: {value:,}")
+
+
+if __name__ == "__main__":
+    main()
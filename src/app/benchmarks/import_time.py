@@ -0,0 +1,112 @@
+# Cold start benchmark: how long it takes to import the bot and its modules.
+#
+# Usage, from src/app:
+#   python -m benchmarks.import_time --repeat 10 --output imports.json
+#
+# Every target is imported --repeat times, each time in a new interpreter
+# with -X importtime, as a scale-to-zero container would on its first
+# request. The report has the median of the import time of each target, the
+# wall time of the process minus an empty interpreter, and the packages that
+# took the longest, as JSON. "bot" loads chatbot-telegram.py without running
+# it. The lazy targets are what the first receipt loads on top of the bot.
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from benchmarks.end_to_end import APP_DIR, BOT_SCRIPT, git_commit
+
+LOAD_BOT = (
+    "import importlib.util\n"
+    f"spec = importlib.util.spec_from_file_location('chatbot_telegram', {str(BOT_SCRIPT)!r})\n"
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+)
+TARGETS = {
+    "bot": LOAD_BOT,
+    "functions.invoice": "import functions.invoice",
+    "functions.supabase": "import functions.supabase",
+    "functions.quota": "import functions.quota",
+    "functions.persistence": "import functions.persistence",
+    "functions.webhook": "import functions.webhook",
+    "lazy: google.genai": "import google.genai",
+    "lazy: functions.supabase_pool": "import functions.supabase_pool",
+}
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def run_once(code: str) -> tuple:
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=APP_DIR,
+        env={**os.environ, "METRICS_PORT": "0"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    # Only the modules imported directly by the code (no indentation) are
+    # added up, their cumulative time already includes what they import.
+    total = 0
+    packages = defaultdict(int)
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        own, cumulative, indent, name = match.groups()
+        if not indent:
+            total += int(cumulative)
+        packages[name.split(".")[0]] += int(own)
+    return wall, total / 1e6, packages
+
+
+def measure(code: str, repeat: int, baseline: float) -> dict:
+    walls, imports = [], []
+    packages = defaultdict(list)
+    for _ in range(repeat):
+        wall, total, own = run_once(code)
+        walls.append(wall)
+        imports.append(total)
+        for name, microseconds in own.items():
+            packages[name].append(microseconds / 1e6)
+    slowest = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:10]
+    return {
+        "import_seconds": statistics.median(imports),
+        "wall_seconds": max(0.0, statistics.median(walls) - baseline),
+        "slowest_packages": {name: statistics.median(values) for name, values in slowest},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import time of the bot and its modules in fresh interpreters")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per target")
+    parser.add_argument("--target", action="append", choices=list(TARGETS), help="Only these targets, all by default")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+    # Warm the filesystem cache and the bytecode so every run starts alike
+    for code in TARGETS.values():
+        run_once(code)
+    baseline = statistics.median(run_once("pass")[0] for _ in range(args.repeat))
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "repeat": args.repeat,
+        "interpreter_seconds": baseline,
+        "targets": {
+            name: measure(TARGETS[name], args.repeat, baseline)
+            for name in args.target or TARGETS
+        },
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# Calibration and benchmark of the quality checks of functions.quality.
+#
+# Usage, from src/app:
+#   python -m benchmarks.quality_gate path/to/fixtures
+#   python -m benchmarks.quality_gate path/to/fixtures --calibrate --max-false-rejections 0.01
+#
+# The fixtures are labeled by folder: photos under good/ are receipts Gemini
+# reads well, everything else (bad/, or bad/blurry/, bad/dark/...) should be
+# rejected. The report counts the Gemini calls the gate avoids, the good
+# photos it turns away and the time of the checks, with the thresholds of
+# the environment. --calibrate also searches, one measure at a time, the
+# thresholds that reject the most bad photos while turning away at most
+# --max-false-rejections of the good ones, and prints them as env vars.
+#
+# --synthetic COUNT writes a small labeled set made from the benchmark photos
+# (blurred, darkened, with glare...) and e-receipt screenshots to try the
+# script without real photos. Do not calibrate production thresholds on it.
+import argparse
+import io
+import json
+import time
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+from benchmarks.image_normalization import IMAGE_SUFFIXES
+from benchmarks.stats import latency_summary
+from functions.quality import CHECKS, THRESHOLDS, image_measures, quality_issue
+from functions.quota import gemini_estimated_tokens
+
+ENV_NAMES = {
+    "brightness": "QUALITY_MIN_BRIGHTNESS",
+    "clipped": "QUALITY_MAX_CLIPPED",
+    "contrast": "QUALITY_MIN_CONTRAST",
+    "sharpness": "QUALITY_MIN_SHARPNESS",
+    "paper": "QUALITY_MIN_PAPER",
+    "text_edges": "QUALITY_MIN_TEXT_EDGES",
+}
+
+
+def load_fixtures(fixtures: Path) -> list:
+    rows = []
+    for path in sorted(fixtures.rglob("*")):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        parts = path.relative_to(fixtures).parts
+        image_bytes = path.read_bytes()
+        start = time.perf_counter()
+        measures = image_measures(image_bytes)
+        rows.append({
+            "file": str(path.relative_to(fixtures)),
+            "good": parts[0] == "good",
+            # bad/blurry/x.jpg is expected to be rejected as blurry
+            "expected": parts[1] if parts[0] != "good" and len(parts) > 2 else None,
+            "seconds": time.perf_counter() - start,
+            "measures": measures,
+        })
+    return rows
+
+
+def evaluate(rows: list, thresholds: dict) -> dict:
+    good = [row for row in rows if row["good"]]
+    bad = [row for row in rows if not row["good"]]
+    false_rejections = [
+        {"file": row["file"], "reason": reason}
+        for row in good
+        if (reason := quality_issue(row["measures"], thresholds))
+    ]
+    reasons = {}
+    missed = []
+    for row in bad:
+        reason = quality_issue(row["measures"], thresholds)
+        if reason is None:
+            missed.append(row["file"])
+        else:
+            reasons[reason] = reasons.get(reason, 0) + 1
+    rejected = len(bad) - len(missed)
+    return {
+        "good": len(good),
+        "bad": len(bad),
+        "gemini_calls_avoided": rejected,
+        "tokens_avoided_estimate": rejected * gemini_estimated_tokens,
+        "bad_rejected_rate": rejected / len(bad) if bad else 0.0,
+        "false_rejections": len(false_rejections),
+        "false_rejection_rate": len(false_rejections) / len(good) if good else 0.0,
+        "rejections_by_reason": reasons,
+        "wrong_reason": [
+            row["file"] for row in bad
+            if row["expected"] and quality_issue(row["measures"], thresholds) not in (None, row["expected"])
+        ],
+        "false_rejected_files": false_rejections,
+        "missed_files": missed,
+    }
+
+
+def candidates(values: list, bound: str) -> list:
+    # Thresholds between every pair of observed values, plus one that
+    # rejects nothing, from the most lenient to the strictest
+    ordered = sorted(set(values))
+    middle = [(low + high) / 2 for low, high in zip(ordered, ordered[1:])]
+    if bound == "min":
+        return [ordered[0]] + middle + [ordered[-1] + 1e-9]
+    return [ordered[-1]] + middle[::-1] + [ordered[0] - 1e-9]
+
+
+def calibrate(rows: list, max_false_rejections: float) -> dict:
+    # Coordinate search: each measure in turn moves to the threshold that
+    # rejects the most bad photos within the budget of false rejections. A
+    # threshold only moves when that rejects more (or the current one goes
+    # over the budget), the most lenient one on ties, so the reasons of the
+    # current thresholds are kept. Two passes let the measures settle.
+    thresholds = dict(THRESHOLDS)
+    measures = {measure: bound for _, measure, bound in CHECKS}
+    for _ in range(2):
+        for measure, bound in measures.items():
+            best = None
+            current = evaluate(rows, thresholds)
+            if current["false_rejection_rate"] <= max_false_rejections:
+                best = (current["gemini_calls_avoided"], thresholds[measure])
+            for threshold in candidates([row["measures"][measure] for row in rows], bound):
+                result = evaluate(rows, {**thresholds, measure: threshold})
+                if result["false_rejection_rate"] > max_false_rejections:
+                    continue
+                if best is None or result["gemini_calls_avoided"] > best[0]:
+                    best = (result["gemini_calls_avoided"], threshold)
+            if best is not None:
+                thresholds[measure] = best[1]
+    return thresholds
+
+
+def jpeg(image: Image.Image) -> bytes:
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def glare(image: Image.Image) -> Image.Image:
+    # The reflection of a flash: a burnt out blob over the middle of the receipt
+    width, height = image.size
+    mask = Image.new("L", image.size, 0)
+    ImageDraw.Draw(mask).ellipse([width * 0.2, height * 0.25, width * 0.8, height * 0.65], fill=255)
+    return Image.composite(Image.new("RGB", image.size, (255, 255, 255)), image, mask.filter(ImageFilter.GaussianBlur(40)))
+
+
+def write_synthetic(directory: Path, count: int) -> None:
+    from benchmarks.fakes import receipt_photo, receipt_screenshot
+    variants = {
+        "good": lambda image: image,
+        "bad/blurry": lambda image: image.filter(ImageFilter.GaussianBlur(3)),
+        "bad/dark": lambda image: ImageEnhance.Brightness(image).enhance(0.15),
+        "bad/overexposed": glare,
+        # Burnt out whole, the text is gone with the paper
+        "bad/low_contrast": lambda image: ImageEnhance.Brightness(image).enhance(8),
+        # Unreadable, without a reason of its own: any rejection counts
+        "bad": lambda image: image.resize((24, 32)).resize(image.size, Image.Resampling.BICUBIC),
+    }
+    for folder, transform in variants.items():
+        (directory / folder).mkdir(parents=True, exist_ok=True)
+        for seed in range(count):
+            with Image.open(io.BytesIO(receipt_photo(seed))) as image:
+                (directory / folder / f"{seed}.jpg").write_bytes(jpeg(transform(image)))
+    # E-receipts shared as screenshots: white all around and sparse text
+    for seed in range(count):
+        (directory / "good" / f"screenshot-{seed}.jpg").write_bytes(receipt_screenshot(seed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calibration and benchmark of the photo quality checks")
+    parser.add_argument("fixtures", type=Path, help="Directory with good/ and bad/ photos")
+    parser.add_argument("--calibrate", action="store_true", help="Search thresholds for the fixtures")
+    parser.add_argument("--max-false-rejections", type=float, default=0.01, help="Share of good photos the calibration may reject")
+    parser.add_argument("--synthetic", type=int, metavar="COUNT", help="First write COUNT synthetic photos of each kind to the directory")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        write_synthetic(args.fixtures, args.synthetic)
+    rows = load_fixtures(args.fixtures)
+    if not rows:
+        parser.error(f"No images found in {args.fixtures}")
+    report = {
+        "fixtures": len(rows),
+        "check_seconds": latency_summary([row["seconds"] for row in rows]),
+        "thresholds": THRESHOLDS,
+        "current": evaluate(rows, THRESHOLDS),
+    }
+    if args.calibrate:
+        thresholds = calibrate(rows, args.max_false_rejections)
+        report["calibrated"] = evaluate(rows, thresholds)
+        report["env"] = {ENV_NAMES[measure]: round(value, 4) for measure, value in thresholds.items()}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
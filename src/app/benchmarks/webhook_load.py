@@ -0,0 +1,168 @@
+# Load test of the webhook mode with synthetic updates.
+#
+# Usage, from src/app:
+#   python -m benchmarks.webhook_load --workers 4 --chats 200 --updates 5 --concurrency 50
+#
+# Starts a fake Bot API, launches chatbot-telegram.py as a webhook router with
+# --workers worker processes (or a single worker with --workers 0) pointed at
+# it, and posts "hola" updates from --chats chats. Every update is answered
+# with the main menu, so the latency of an update is the time between the
+# POST and the sendMessage the fake Bot API receives for that chat.
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+import aiohttp
+from aiohttp import web
+from benchmarks.fakes import create_fake_bot_api
+from benchmarks.stats import latency_summary
+
+BOT_SCRIPT = Path(__file__).resolve().parent.parent / "chatbot-telegram.py"
+TOKEN = "123456:benchmark"
+SECRET = "benchmark-secret"
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+            "text": text,
+        },
+    }
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, url: str, ready, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200 and ready():
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not become ready")
+
+
+async def run(args) -> dict:
+    sent_at = defaultdict(deque)
+    latencies = []
+    bots_ready = []
+
+    def on_request(method: str, params: dict, received_at: float) -> None:
+        if method == "getMe":
+            bots_ready.append(received_at)
+        elif method == "sendMessage":
+            pending = sent_at[int(params["chat_id"])]
+            if pending:
+                latencies.append(received_at - pending.popleft())
+
+    api = web.AppRunner(create_fake_bot_api(on_request))
+    await api.setup()
+    await web.TCPSite(api, "127.0.0.1", args.api_port).start()
+
+    workdir = tempfile.mkdtemp(prefix="kooko-load-")
+    env = {
+        **os.environ,
+        "TELEGRAM_BOTFATHER_API_KEY": TOKEN,
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{args.api_port}",
+        "BOT_MODE": "webhook",
+        "WEBHOOK_ROLE": "router" if args.workers else "worker",
+        "WEBHOOK_WORKERS": str(args.workers),
+        "WEBHOOK_WORKER_URLS": "",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(args.port),
+        "WEBHOOK_URL": "",
+        "WEBHOOK_SECRET_TOKEN": SECRET,
+        # Unreachable on purpose: the "hola" flow does not touch Supabase
+        "SUPABASE_URL": "http://127.0.0.1:9",
+        "SUPABASE_ANON_KEY": "bench.mark.key",
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.sqlite3"),
+        "SESSION_STORE": "sqlite",
+        "SESSION_STORE_PATH": os.path.join(workdir, "sessions.sqlite3"),
+    }
+    # The bot logs every request; keep them out of the JSON on stdout
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    bot = subprocess.Popen([sys.executable, str(BOT_SCRIPT)], env=env, cwd=BOT_SCRIPT.parent, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{args.port}/telegram"
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_ready(
+                session,
+                f"http://127.0.0.1:{args.port}/healthz",
+                lambda: len(bots_ready) >= max(args.workers, 1),
+            )
+            # Let the workers finish post_init before measuring
+            await asyncio.sleep(1)
+            slots = asyncio.Semaphore(args.concurrency)
+            errors = 0
+
+            async def post(update_id: int, chat_id: int) -> None:
+                nonlocal errors
+                async with slots:
+                    sent_at[chat_id].append(time.perf_counter())
+                    try:
+                        async with session.post(
+                            url,
+                            json=text_update(update_id, chat_id, "hola"),
+                            headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                        ) as response:
+                            if response.status != 200:
+                                errors += 1
+                    except aiohttp.ClientError:
+                        errors += 1
+
+            total = args.chats * args.updates
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                post(update_id, 100000 + update_id % args.chats)
+                for update_id in range(total)
+            ))
+            deadline = time.monotonic() + args.timeout
+            while len(latencies) < total - errors and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - start
+    finally:
+        bot.terminate()
+        bot.wait()
+        log.close()
+        await api.cleanup()
+    return {
+        "log": log.name,
+        "workers": args.workers,
+        "chats": args.chats,
+        "updates": total,
+        "answered": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "updates_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": latency_summary(latencies),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the webhook mode")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes behind the router, 0 for a single worker")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=5, help="Updates sent by each chat")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once")
+    parser.add_argument("--port", type=int, default=8480)
+    parser.add_argument("--api-port", type=int, default=8479)
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for the last replies")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,35 @@
 
 # Telegram libraries
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import TelegramError
 from telegram.constants import ParseMode
 # Config libraries
+import asyncio
+import importlib
 import logging
 import os
 from pathlib import Path
-import tempfile
 import re
+import tempfile
+import time
+import uuid
+from datetime import datetime
 import httpx
 from dotenv import load_dotenv
 # Importing functions
-from functions.invoice import invoice_processing, format_money, sum_all_taxes
-from functions.supabase import verify_user, insert_invoice_data, insert_invoice_detail_data, insert_user_credits_data, upload_file
+from functions.invoice import invoice_processing, format_money, sum_all_taxes, get_gemini_client, tz
+from functions.cache import ocr_cache
+from functions.image import normalize_image
+from functions.quality import check_image, UnusableImage
+from functions.jobs import receipt_queue, QueueFull, RetryLater, UserQueueFull
+from functions.quota import gemini_scheduler, GeminiBusy
+from functions.credits import credits_buffer
+from functions.export import EXPORT_FORMATS, ExportUnavailable, InvoiceExport, export_slots
+from functions.updates import ChatOrderedUpdateProcessor
+from functions.persistence import create_session_persistence
+from functions.metrics import IN_FLIGHT, configure_logging, span, start_metrics_server, timed, track_queue
+from functions.supabase import verify_user, invalidate_user, warm_user, save_invoices, get_supabase_client, check_supabase_health, close_supabase_client
 
 # Name of the bot: Dolfin.ai
 # Link of Telegram Bot: https://t.me/DolfinAIBot
@@ -25,12 +41,36 @@ dotenv_path = Path(__file__).resolve().parent.parent.parent / ".env"
 load_dotenv(dotenv_path=dotenv_path)
 
 TELEGRAM_API_KEY = os.getenv("TELEGRAM_BOTFATHER_API_KEY")
+# Updates handled at the same time
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+# Background workers that take receipts from the durable queue
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", "4"))
+# "polling" or "webhook". In webhook mode a process is either a "worker" that
+# handles updates or a "router" that spreads them among workers by chat.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_ROLE = os.getenv("WEBHOOK_ROLE", "worker")
+# Self-hosted Bot API server (or the fake one of the benchmarks)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+
+# Seconds to wait for more photos of the same album before processing it
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.5"))
+# Minimum seconds between two edits of the status message of a receipt
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1"))
+
+media_groups = {}
+warm_up_task = None
+
+# What the user is asked to fix when a photo fails the quality checks
+RETAKE_MESSAGES = {
+    "dark": "📷 La foto salió muy oscura. Por favor, tómala con más luz y envíamela otra vez.",
+    "overexposed": "📷 La foto tiene mucho brillo o reflejo. Evita el flash directo y envíamela otra vez.",
+    "low_contrast": "📷 No se distingue el texto de la boleta. Tómala con mejor luz y envíamela otra vez.",
+    "blurry": "📷 La foto salió borrosa. Mantén el celular quieto, enfoca la boleta y envíamela otra vez.",
+    "not_document": "📷 No encuentro una boleta o factura en la imagen. Asegúrate de que se vea completa y envíamela otra vez.",
+}
 
 # Config to improve the method to find errors
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+configure_logging(logging.INFO)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
@@ -55,6 +95,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
 
+@timed("handler.text")
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_input = update.message.text.strip().lower()
     if context.user_data.get("waiting_for_phone"):
@@ -65,7 +106,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         if phone_match:
             context.user_data["user_phone"] = user_input
             del context.user_data["waiting_for_phone"]
-            await update.message.reply_text("✅ ¡Gracias! Tu número ha sido registrado correctamente. Ahora puedes subir una imagen.")
+            # Look the user up now so the first receipt finds it cached
+            context.application.create_task(warm_user(user_input), update=update)
+            await update.message.reply_text(
+                "✅ ¡Gracias! Tu número ha sido registrado correctamente. Ahora puedes subir una imagen.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
         else:
             await update.message.reply_text("⚠️ El número ingresado no es válido. Debes enviar con el prefijo de tu país, por ejemplo, +51 para Perú.")
         return
@@ -74,6 +120,39 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
 
+def contact_keyboard() -> ReplyKeyboardMarkup:
+    # Telegram fills the contact with the number of the account itself
+    return ReplyKeyboardMarkup(
+        [[KeyboardButton("📱 Compartir mi número", request_contact=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+
+
+@timed("handler.contact")
+async def receive_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # A typed number can be anyone's. A shared contact whose user_id is the
+    # sender's own is the number of this Telegram account, which is what
+    # /export asks for before sending the history.
+    contact = update.message.contact
+    if contact.user_id != update.effective_user.id:
+        await update.message.reply_text(
+            "⚠️ Solo puedo registrar tu propio número. Compártelo con el botón «Compartir mi número».",
+            reply_markup=contact_keyboard(),
+        )
+        return
+    user_phone = "+" + contact.phone_number.lstrip("+")
+    context.user_data["user_phone"] = user_phone
+    context.user_data["phone_verified"] = True
+    context.user_data.pop("waiting_for_phone", None)
+    context.application.create_task(warm_user(user_phone), update=update)
+    await update.message.reply_text(
+        "✅ ¡Gracias! Tu número ha sido registrado correctamente. Ahora puedes subir una imagen.",
+        reply_markup=ReplyKeyboardRemove(),
+    )
+
+
+@timed("handler.button")
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -106,111 +185,493 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             context.user_data.clear()
     elif query.data == "want-to-register":
         context.user_data["waiting_for_phone"] = True
-        await query.message.reply_text("👨🏻‍💻 Solo requiero que me envíes el número de celular que estás utilizando en este chat con el prefijo de tu país. Por ejemplo, +51987535574 para Perú.")
+        await query.message.reply_text(
+            "👨🏻‍💻 Solo requiero que compartas el número de celular que estás utilizando en este chat con el botón «Compartir mi número», o que me lo envíes con el prefijo de tu país. Por ejemplo, +51987535574 para Perú.",
+            reply_markup=contact_keyboard(),
+        )
 
 
-async def receive_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def identify_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     # First, we will verify if the user is already registered by full name
     if "user_phone" not in context.user_data:
         await update.message.reply_text("⚠️ Hey, no tengo cómo validar tu identidad.\nPor favor, envíame tu número de celular antes de subir una imagen.")
-        return
+        return None
     user_phone = context.user_data["user_phone"]
 
     try:
-        user_id = verify_user(user_phone=user_phone)
+        user_id = await verify_user(user_phone=user_phone)
     except httpx.ConnectTimeout:
         await update.message.reply_text("⚠️ Error de conexión con el servidor. Intenta nuevamente en unos minutos.")
-        return
+        return None
     except httpx.RequestError as e:
         await update.message.reply_text("⚠️ No se pudo conectar con el servidor. Verifica tu conexión a internet.")
-        return
+        return None
 
     if not user_id:
         await update.message.reply_text("⚠️ El número enviado no está registrado en nuestro sistema. Por favor, envíame un número válido.")
+        invalidate_user(user_phone)
         del context.user_data['user_phone']
-        return
+        context.user_data.pop("phone_verified", None)
+        return None
+    return user_id
 
-    photo = update.message.photo[-1]  # Get the better photo
-    file_id = photo.file_id
-    file = await context.bot.get_file(file_id)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-        local_file_path = temp_file.name
-    try:
-        await file.download_to_drive(local_file_path)
-        await update.message.reply_text("👨🏻‍💻 Gracias por enviarme la imagen. Estoy procesando...")
-        processing_result = invoice_processing(path_file=local_file_path)
-        processing_data = processing_result["data"]
-        products_info = ""
-        total_amount = 0
-        all_taxes = sum_all_taxes(processing_data["taxes"])
-        for product in processing_data["products"]:
-            name = product["product_name"] or ""
-            price = float(product["unit_price"]
-                          ) if product["unit_price"] is not None else 0
-            quantity = float(product["quantity"]
-                             ) if product["quantity"] is not None else 0
-            subtotal = price * quantity
-            total_amount += subtotal
-            products_info += f"\n - {name}: {format_money(price)} x {quantity}u"
-
-        res_upload_file = upload_file(f"{local_file_path}", user_id=user_id)
-
-        insert_invoice_data(user_id=user_id,
-                            total=total_amount,
-                            invoice_data=processing_data,
-                            path_file=res_upload_file)
-
-        insert_invoice_detail_data(invoice_detail_data=processing_data)
-
-        insert_user_credits_data(user_id=user_id,
-                                 credits=processing_result)
-        message_text = (
-            f"Por favor, confirma los siguiente datos para culminar el proceso.\n\n"
-            f"<b>N° Factura:</b> {processing_data["id_invoice"]}\n"
-            f"<b>Cliente:</b> {processing_data["client"]["name_client"]} - {processing_data["client"]["id_client"]}\n\n"
-            f"<b>Vendedor:</b> {processing_data["seller"]["name_seller"]} - {processing_data["seller"]["id_seller"]}\n\n"
-            f"<b>Fecha de la compra:</b> {processing_data["date"]}\n\n"
-            f"<b>Productos:</b> {products_info}\n\n"
-            f"<b>Total de impuestos:</b> {format_money(all_taxes)}\n\n"
-            f"<b>Total:</b> {format_money(total_amount + all_taxes)}"
+
+class ProgressMessage:
+    # Edits the "Estoy procesando..." message in place while the receipt is
+    # read. Only the latest text is kept and it is shown at most once every
+    # PROGRESS_EDIT_INTERVAL seconds, so fast updates never hit the rate limit.
+    def __init__(self, bot: Bot, chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._text = None
+        self._shown = None
+        self._last_edit = 0.0
+        self._task = None
+
+    def update(self, text: str) -> None:
+        if not text:
+            return
+        self._text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._edit())
+
+    async def _edit(self) -> None:
+        while self._text != self._shown:
+            await asyncio.sleep(max(0.0, self._last_edit + PROGRESS_EDIT_INTERVAL - time.monotonic()))
+            text = self._text
+            self._last_edit = time.monotonic()
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    text=text,
+                    parse_mode=ParseMode.HTML,
+                )
+            except TelegramError as e:
+                logger.warning("Error al actualizar el mensaje de progreso: %s", e)
+                return
+            self._shown = text
+
+    async def finish(self, text: str, reply_markup: InlineKeyboardMarkup) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML,
+            )
+        except TelegramError as e:
+            # The status message was deleted or can no longer be edited
+            logger.warning("Error al editar el mensaje de progreso: %s", e)
+            await self.bot.send_message(
+                chat_id=self.chat_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML,
+            )
+
+
+def progress_message(partial: dict) -> str:
+    # What Gemini has read so far; empty until there is something to show
+    seller = partial.get("seller") or {}
+    products = [product for product in partial.get("products") or [] if product.get("product_name")]
+    message_text = ""
+    if partial.get("id_invoice"):
+        message_text += f"<b>N° Factura:</b> {partial["id_invoice"]}\n"
+    if seller.get("name_seller"):
+        message_text += f"<b>Vendedor:</b> {seller["name_seller"]} - {seller.get("id_seller") or ""}\n"
+    if partial.get("date"):
+        message_text += f"<b>Fecha de la compra:</b> {partial["date"]}\n"
+    if products:
+        message_text += "\n<b>Productos:</b>"
+        for product in products:
+            message_text += f"\n - {product["product_name"]}: {format_money(product.get("unit_price") or 0)} x {float(product.get("quantity") or 0)}u"
+    if not message_text:
+        return ""
+    return f"👨🏻‍💻 Estoy leyendo tu boleta...\n\n{message_text}"
+
+
+async def read_receipt(bot: Bot, file_id: str, user_id: str, on_progress=None, on_wait=None) -> dict:
+    with span("telegram.get_file"):
+        file = await bot.get_file(file_id)
+    # The photo is kept in memory and the same buffer goes to Gemini and Storage
+    with span("telegram.download"):
+        image_bytes = bytes(await file.download_as_bytearray())
+    # Blurry, dark or non-receipt photos are turned away before Gemini
+    with span("image.quality", expected=(UnusableImage,)):
+        await asyncio.to_thread(check_image, image_bytes)
+    # A small grayscale copy goes to Gemini and a color copy to Storage
+    with span("image.normalize"):
+        ocr_bytes, archive_bytes = await asyncio.to_thread(normalize_image, image_bytes)
+    with span("ocr_cache.get"):
+        processing_result = await ocr_cache.get(image_bytes)
+    if processing_result is None:
+        # Waits for the quota and the turn of the user, retries 429/503
+        processing_result = await gemini_scheduler.run(
+            user_id,
+            lambda: invoice_processing(image_bytes=ocr_bytes, on_progress=on_progress),
+            on_wait=on_wait,
+            # Both calls would edit the same status message
+            hedge=on_progress is None,
         )
-        keyboards = [
-            [
-                InlineKeyboardButton(
-                    "✅ Aceptar", callback_data="confirm-invoice"),
-            ],
-            [
-                InlineKeyboardButton(
-                    "🛒 Olvidaste algunos productos", callback_data="forgot-products"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(
-            keyboards,
+        with span("ocr_cache.put"):
+            await ocr_cache.put(image_bytes, processing_result)
+    else:
+        logger.info("OCR cache hit: %s", ocr_cache.stats())
+    processing_data = processing_result["data"]
+    products_info = ""
+    total_amount = 0
+    all_taxes = sum_all_taxes(processing_data["taxes"])
+    for product in processing_data["products"]:
+        name = product["product_name"] or ""
+        price = float(product["unit_price"]
+                      ) if product["unit_price"] is not None else 0
+        quantity = float(product["quantity"]
+                         ) if product["quantity"] is not None else 0
+        subtotal = price * quantity
+        total_amount += subtotal
+        products_info += f"\n - {name}: {format_money(price)} x {quantity}u"
+    return {
+        "total": total_amount,
+        "invoice_data": processing_data,
+        "image_bytes": archive_bytes,
+        # A cached result did not spend any Gemini tokens
+        "credits": None if processing_result.get("cached") else processing_result,
+        "products_info": products_info,
+        "all_taxes": all_taxes,
+    }
+
+
+def confirmation_message(receipt: dict) -> str:
+    processing_data = receipt["invoice_data"]
+    return (
+        f"Por favor, confirma los siguiente datos para culminar el proceso.\n\n"
+        f"<b>N° Factura:</b> {processing_data["id_invoice"]}\n"
+        f"<b>Cliente:</b> {processing_data["client"]["name_client"]} - {processing_data["client"]["id_client"]}\n\n"
+        f"<b>Vendedor:</b> {processing_data["seller"]["name_seller"]} - {processing_data["seller"]["id_seller"]}\n\n"
+        f"<b>Fecha de la compra:</b> {processing_data["date"]}\n\n"
+        f"<b>Productos:</b> {receipt["products_info"]}\n\n"
+        f"<b>Total de impuestos:</b> {format_money(receipt["all_taxes"])}\n\n"
+        f"<b>Total:</b> {format_money(receipt["total"] + receipt["all_taxes"])}"
+    )
+
+
+def album_summary_message(receipts: list, failed: int) -> str:
+    message_text = f"Por favor, confirma los datos de las {len(receipts)} boletas y/o facturas para culminar el proceso.\n\n"
+    grand_total = 0
+    for index, receipt in enumerate(receipts, start=1):
+        processing_data = receipt["invoice_data"]
+        total = receipt["total"] + receipt["all_taxes"]
+        grand_total += total
+        message_text += (
+            f"<b>{index}. N° Factura:</b> {processing_data["id_invoice"]}\n"
+            f"<b>Vendedor:</b> {processing_data["seller"]["name_seller"]}\n"
+            f"<b>Fecha de la compra:</b> {processing_data["date"]} - <b>Total:</b> {format_money(total)}\n\n"
         )
-        await update.message.reply_text(
-            message_text,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.HTML,
+    message_text += f"<b>Total general:</b> {format_money(grand_total)}"
+    if failed:
+        message_text += f"\n\n⚠️ No pude procesar {failed} de las imágenes. Por favor, envíalas nuevamente."
+    return message_text
+
+
+@timed("receipt.job")
+async def process_receipt_job(bot: Bot, payload: dict) -> None:
+    with IN_FLIGHT.labels("jobs").track_inprogress():
+        await run_receipt_job(bot, payload)
+
+
+async def run_receipt_job(bot: Bot, payload: dict) -> None:
+    status = None
+    on_progress = None
+    on_wait = None
+    if payload.get("status_message_id"):
+        status = ProgressMessage(bot, payload["chat_id"], payload["status_message_id"])
+        # A single receipt is shown while it is read, an album only at the end
+        if len(payload["file_ids"]) == 1:
+            on_progress = lambda partial: status.update(progress_message(partial))
+        on_wait = lambda wait: status.update(
+            f"⏳ Estoy atendiendo muchas boletas en este momento. La tuya empezará en unos {int(wait) + 1} segundos."
         )
-    except Exception as e:
-        await update.message.reply_text(f"⚠️ Ha ocurrido un error al procesar la imagen. 😔")
-        print(f"Error al procesar la imagen: {e}")
-    finally:
-        try:
-            os.remove(local_file_path)
-        except OSError as e:
-            print(f"Error al eliminar el archivo: {e}")
+    # Every photo goes to Gemini in parallel, bounded by gemini_scheduler
+    results = await asyncio.gather(
+        *(read_receipt(bot, file_id, payload["user_id"], on_progress, on_wait) for file_id in payload["file_ids"]),
+        return_exceptions=True,
+    )
+    receipts = []
+    for index, result in enumerate(results):
+        if isinstance(result, UnusableImage):
+            logger.info("Imagen rechazada por su calidad: %s", result.reason)
+        elif isinstance(result, GeminiBusy):
+            logger.info("Imagen en espera de cuota de Gemini: %s", result)
+        elif isinstance(result, Exception):
+            logger.error("Error al procesar la imagen: %r", result, exc_info=result)
+        else:
+            # The position of the photo names its file and its idempotency
+            # key, the same on every run of the job
+            result["index"] = index
+            receipts.append(result)
+    # Gemini already spent the tokens: record them even if saving fails or
+    # the job is retried (the retry finds these photos in the OCR cache)
+    for receipt in receipts:
+        credits = receipt.pop("credits")
+        if credits:
+            credits_buffer.add(payload["user_id"], credits)
+    busy = [result for result in results if isinstance(result, GeminiBusy)]
+    if busy:
+        # Out of quota is temporary: run the whole job again once the quota
+        # is estimated to be back, without using up its attempts, instead of
+        # dropping these photos from the album
+        if status is not None:
+            status.update("⏳ Hay mucha demanda en este momento. Seguiré intentando con tu boleta en unos minutos.")
+        raise RetryLater(max(result.wait for result in busy)) from busy[0]
+    if not receipts:
+        if all(isinstance(result, UnusableImage) for result in results):
+            # Retrying would reject the same photos: ask for new ones instead
+            message_text = RETAKE_MESSAGES[results[0].reason]
+            if status is not None:
+                await status.finish(message_text, None)
+            else:
+                await bot.send_message(chat_id=payload["chat_id"], text=message_text)
+            return
+        raise results[0]
+    # Jobs enqueued before the idempotency key was added have no "key"
+    await save_invoices(
+        payload["user_id"],
+        receipts,
+        key=payload.get("key"),
+        at=datetime.fromtimestamp(payload["created_at"], tz) if "created_at" in payload else None,
+    )
+    if len(results) == 1:
+        message_text = confirmation_message(receipts[0])
+    else:
+        message_text = album_summary_message(receipts, len(results) - len(receipts))
+    keyboards = [
+        [
+            InlineKeyboardButton(
+                "✅ Aceptar", callback_data="confirm-invoice"),
+        ],
+        [
+            InlineKeyboardButton(
+                "🛒 Olvidaste algunos productos", callback_data="forgot-products"),
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(
+        keyboards,
+    )
+    # The invoices are already stored: failing to answer must not retry the job
+    try:
+        with span("telegram.confirmation"):
+            if status is not None:
+                await status.finish(message_text, reply_markup)
+            else:
+                await bot.send_message(
+                    chat_id=payload["chat_id"],
+                    text=message_text,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML,
+                )
+    except TelegramError as e:
+        logger.error("Error al enviar la confirmación: %s", e)
+
+
+async def notify_failed_job(bot: Bot, payload: dict) -> None:
+    await bot.send_message(
+        chat_id=payload["chat_id"],
+        text="⚠️ Ha ocurrido un error al procesar la imagen. 😔",
+    )
+
+
+@timed("receipt.enqueue")
+async def enqueue_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE, messages: list) -> None:
+    user_id = await identify_user(update, context)
+    if not user_id:
+        return
+    if len(messages) == 1:
+        status_message = await update.message.reply_text("👨🏻‍💻 Gracias por enviarme la imagen. Estoy procesando...")
+    else:
+        status_message = await update.message.reply_text(f"👨🏻‍💻 Gracias por enviarme {len(messages)} imágenes. Estoy procesando...")
+    # The job edits this message with the progress and the confirmation
+    payload = {
+        "chat_id": update.effective_chat.id,
+        "user_id": user_id,
+        "file_ids": [message.photo[-1].file_id for message in messages],  # Get the better photo
+        "status_message_id": status_message.message_id,
+        # Saving the receipts again on a retry finds them already stored
+        "key": uuid.uuid4().hex,
+        "created_at": time.time(),
+    }
+    try:
+        await receipt_queue.put(payload, user_id=user_id)
+    except UserQueueFull:
+        await status_message.edit_text("⚠️ Todavía estoy procesando muchas de tus boletas. Espera a que terminen y vuelve a enviarme esta imagen.")
+        return
+    except QueueFull:
+        await status_message.edit_text("⚠️ Estoy recibiendo muchas imágenes en este momento. Por favor, intenta nuevamente en unos minutos.")
+        return
     if "waiting_for" in context.user_data:
         del context.user_data['waiting_for']
 
 
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_API_KEY).build()
+async def receive_album(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Telegram delivers an album as one update per photo: wait until no new
+    # photo arrives for MEDIA_GROUP_WINDOW seconds and process them together.
+    media_group_id = update.message.media_group_id
+    album = media_groups[media_group_id]
+    size = 0
+    while size != len(album):
+        size = len(album)
+        await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    del media_groups[media_group_id]
+    await enqueue_receipts(update, context, sorted(album, key=lambda message: message.message_id))
+
+
+async def receive_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    media_group_id = update.message.media_group_id
+    if media_group_id:
+        album = media_groups.setdefault(media_group_id, [])
+        album.append(update.message)
+        if len(album) == 1:
+            context.application.create_task(receive_album(update, context), update=update)
+        return
+    await enqueue_receipts(update, context, [update.message])
+
+
+@timed("handler.export")
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /export [csv|parquet]: the whole history of the user as files
+    export_format = context.args[0].lower() if context.args else "csv"
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text("⚠️ Puedes exportar en csv o parquet, por ejemplo: /export csv")
+        return
+    if not context.user_data.get("phone_verified"):
+        # The history has names, documents and addresses: a number typed in
+        # the chat is not enough to send it
+        await update.message.reply_text(
+            "🔒 Para enviarte tu historial necesito confirmar que el número es tuyo. Compártelo con el botón «Compartir mi número» y vuelve a pedir /export.",
+            reply_markup=contact_keyboard(),
+        )
+        return
+    user_id = await identify_user(update, context)
+    if not user_id:
+        return
+    status_message = await update.message.reply_text("📦 Estoy preparando tu historial de boletas y/o facturas...")
+    # The export takes minutes on a long history: it runs apart so the chat
+    # keeps answering photos and buttons meanwhile
+    context.application.create_task(
+        export_history(context.bot, update.effective_chat.id, user_id, export_format, status_message),
+        update=update,
+    )
+
+
+@timed("export.history")
+async def export_history(bot: Bot, chat_id: int, user_id: str, export_format: str, status_message) -> None:
+    sent = 0
+    try:
+        async with export_slots:
+            with tempfile.TemporaryDirectory(prefix="kooko-export-") as directory:
+                export = InvoiceExport(user_id, export_format, directory)
+                # Every file is sent as soon as it is written and then deleted
+                async for path in export.files():
+                    with open(path, "rb") as document:
+                        await bot.send_document(
+                            chat_id=chat_id,
+                            document=document,
+                            filename=path.name,
+                            write_timeout=120,
+                        )
+                    path.unlink()
+                    sent += 1
+    except ExportUnavailable:
+        await status_message.edit_text("⚠️ La exportación en parquet no está disponible por ahora. Prueba con /export csv")
+        return
+    except Exception as e:
+        logger.exception("Error al exportar el historial: %s", e)
+        await status_message.edit_text("⚠️ No pude exportar tu historial. Intenta nuevamente en unos minutos.")
+        return
+    if not sent:
+        await status_message.edit_text("📭 Todavía no tienes boletas y/o facturas registradas.")
+        return
+    await status_message.edit_text(
+        f"✅ Listo: {export.invoices.rows} boletas y/o facturas y {export.products.rows} productos en {sent} archivos."
+    )
+
+
+async def warm_up() -> None:
+    # Opens the shared Supabase client and loads the Gemini SDK and numpy (for
+    # the quality checks) so the first receipt does not pay for them, while
+    # the bot is already answering
+    try:
+        await get_supabase_client()
+        if not await check_supabase_health():
+            logger.warning("Supabase no respondió al iniciar el bot")
+        await asyncio.to_thread(get_gemini_client)
+        await asyncio.to_thread(importlib.import_module, "numpy")
+    except Exception as e:
+        logger.warning("No se pudo preparar los clientes al iniciar: %s", e)
+
+
+async def post_init(application: Application) -> None:
+    global warm_up_task
+    warm_up_task = asyncio.create_task(warm_up())
+    start_metrics_server()
+    track_queue(receipt_queue.counts)
+    IN_FLIGHT.labels("gemini_waiting").set_function(gemini_scheduler.waiting)
+    credits_buffer.start()
+    await receipt_queue.start(
+        lambda payload: process_receipt_job(application.bot, payload),
+        workers=RECEIPT_WORKERS,
+        on_dead=lambda payload: notify_failed_job(application.bot, payload),
+    )
+
+
+async def post_stop(application: Application) -> None:
+    # Jobs still running go back to pending and resume on the next start
+    await receipt_queue.stop()
+
+
+async def post_shutdown(application: Application) -> None:
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    await credits_buffer.stop()
+    await close_supabase_client()
+    logger.info("OCR cache: %s", ocr_cache.stats())
+    ocr_cache.close()
+
+
+def add_handlers(application: Application) -> None:
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(MessageHandler(filters.PHOTO, receive_image))
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.add_handler(MessageHandler(filters.CONTACT, receive_contact))
+
+
+def main() -> None:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_API_KEY)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .persistence(create_session_persistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    application = builder.build()
+    add_handlers(application)
+    if BOT_MODE == "webhook":
+        # aiohttp is only loaded in webhook mode
+        from functions.webhook import run_webhook
+        run_webhook(application, role=WEBHOOK_ROLE, script=os.path.abspath(__file__))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from functions.env import load_env
+
+load_env()
+ocr_cache_path = os.getenv(
+    "OCR_CACHE_PATH",
+    str(Path(__file__).resolve().parent.parent.parent.parent / "ocr_cache.sqlite3"),
+)
+ocr_cache_size = int(os.getenv("OCR_CACHE_SIZE", "512"))
+ocr_cache_ttl = float(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 60 * 60)))
+# Matching re-compressed copies is opt-in: two receipts of the same store can
+# look alike, so only enable it when exact resends are not enough.
+ocr_cache_phash = os.getenv("OCR_CACHE_PHASH", "false").lower() == "true"
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def image_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data: bytes, hash_size: int = 16) -> str:
+    # Difference hash: compares neighbouring pixels of a tiny grayscale copy,
+    # which survives re-compression and resizing of the same photo. PIL is
+    # loaded here so importing the cache (as functions.supabase does for
+    # TTLCache) does not load it on cold start.
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(
+            image.convert("L")
+            .resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+            .getdata()
+        )
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for column in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    # A featureless image (blank or black photo) has no usable fingerprint
+    if bits == 0:
+        return None
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+class OcrCache:
+    def __init__(self, path: str, maxsize: int, ttl: float, use_phash: bool = False):
+        self.path = path
+        self.ttl = ttl
+        self.use_phash = use_phash
+        self.memory = TTLCache(maxsize, ttl)
+        self.hits = 0
+        self.phash_hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS ocr_results (
+                    digest TEXT PRIMARY KEY,
+                    phash TEXT,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ocr_results_phash ON ocr_results (phash);
+                CREATE INDEX IF NOT EXISTS ocr_results_created_at ON ocr_results (created_at);
+                """
+            )
+        return self._connection
+
+    def _load(self, column: str, key: str):
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT result FROM ocr_results WHERE {column} = ? AND created_at >= ? LIMIT 1",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def lookup(self, data: bytes):
+        digest = image_digest(data)
+        result = self.memory.get(f"sha256:{digest}") or self._load("digest", digest)
+        if result is None and self.use_phash:
+            phash = perceptual_hash(data)
+            if phash:
+                result = self.memory.get(f"phash:{phash}") or self._load("phash", phash)
+            if result is not None:
+                self.phash_hits += 1
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.memory.set(f"sha256:{digest}", result)
+        self.tokens_saved += (
+            result["input"]["token_text"]
+            + result["input"]["token_image"]
+            + result["output"]["token_text"]
+        )
+        return {**result, "cached": True}
+
+    def store(self, data: bytes, result: dict) -> None:
+        digest = image_digest(data)
+        phash = perceptual_hash(data) if self.use_phash else None
+        self.memory.set(f"sha256:{digest}", result)
+        if phash:
+            self.memory.set(f"phash:{phash}", result)
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO ocr_results (digest, phash, result, created_at) VALUES (?, ?, ?, ?)",
+                    (digest, phash, json.dumps(result), now),
+                )
+                connection.execute(
+                    "DELETE FROM ocr_results WHERE created_at < ?",
+                    (now - self.ttl,),
+                )
+
+    async def get(self, data: bytes):
+        return await asyncio.to_thread(self.lookup, data)
+
+    async def put(self, data: bytes, result: dict) -> None:
+        await asyncio.to_thread(self.store, data, result)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "phash_hits": self.phash_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "entries_in_memory": len(self.memory),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+ocr_cache = OcrCache(
+    path=ocr_cache_path,
+    maxsize=ocr_cache_size,
+    ttl=ocr_cache_ttl,
+    use_phash=ocr_cache_phash,
+)
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from functions.env import load_env
+from functions.supabase import build_user_credits_row, insert_user_credits_rows
+
+load_env()
+credits_flush_size = int(os.getenv("CREDITS_FLUSH_SIZE", "100"))
+credits_flush_interval = float(os.getenv("CREDITS_FLUSH_INTERVAL", "10"))
+# Rows that could not reach Supabase wait here until the next flush
+credits_spool_path = os.getenv(
+    "CREDITS_SPOOL_PATH",
+    str(Path(__file__).resolve().parent.parent.parent.parent / "credits_spool.jsonl"),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CreditsBuffer:
+    # The token usage of a receipt is not needed to answer the user, so it is
+    # collected here and written in bulk, every flush_interval seconds or as
+    # soon as flush_size rows are waiting. Rows are written at least once: a
+    # crash between an insert and the spool rewrite can repeat a batch.
+    def __init__(self, flush_size: int, flush_interval: float, spool_path: str):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spool_path = Path(spool_path)
+        self._rows = []
+        self._full = None
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def add(self, user_id: str, credits: dict) -> None:
+        self._rows.append(build_user_credits_row(user_id, credits))
+        if len(self._rows) >= self.flush_size and self._full is not None:
+            self._full.set()
+
+    def _read_spool(self) -> list:
+        if not self.spool_path.exists():
+            return []
+        with self.spool_path.open(encoding="utf-8") as spool:
+            return [json.loads(line) for line in spool if line.strip()]
+
+    def _write_spool(self, rows: list) -> None:
+        if not rows:
+            self.spool_path.unlink(missing_ok=True)
+            return
+        temporary = self.spool_path.with_name(f"{self.spool_path.name}.tmp")
+        with temporary.open("w", encoding="utf-8") as spool:
+            spool.writelines(f"{json.dumps(row)}\n" for row in rows)
+        os.replace(temporary, self.spool_path)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            rows = await asyncio.to_thread(self._read_spool) + self._rows
+            self._rows = []
+            if not rows:
+                return
+            for start in range(0, len(rows), self.flush_size):
+                try:
+                    await insert_user_credits_rows(rows[start:start + self.flush_size])
+                except Exception as e:
+                    logger.warning("Error al registrar los créditos, se guardan %s en %s: %s", len(rows) - start, self.spool_path, e)
+                    await asyncio.to_thread(self._write_spool, rows[start:])
+                    return
+            await asyncio.to_thread(self._write_spool, [])
+
+    async def _run(self) -> None:
+        while self._task is not None:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Not cancelled: a flush in progress finishes or spools its rows
+        task, self._task = self._task, None
+        if task is not None:
+            self._full.set()
+            await task
+        await self.flush()
+
+
+credits_buffer = CreditsBuffer(
+    flush_size=credits_flush_size,
+    flush_interval=credits_flush_interval,
+    spool_path=credits_spool_path,
+)
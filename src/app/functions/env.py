@@ -0,0 +1,11 @@
+from functools import cache
+from pathlib import Path
+from dotenv import load_dotenv
+
+dotenv_path = Path(__file__).resolve().parent.parent.parent.parent / ".env"
+
+
+@cache
+def load_env() -> None:
+    # Every module reads its settings when imported, the file is parsed once
+    load_dotenv(dotenv_path=dotenv_path)
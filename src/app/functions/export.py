@@ -0,0 +1,228 @@
+import asyncio
+import csv
+import importlib.util
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+from functions.env import load_env
+from functions.supabase import fetch_invoice_details_page, fetch_invoices_page
+
+if TYPE_CHECKING:
+    import numpy as np
+
+load_env()
+# Rows read from Supabase per request
+export_page_size = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+# Invoices per products request, their ids all go in the query string
+export_detail_batch = int(os.getenv("EXPORT_DETAIL_BATCH", "200"))
+# A new file is started past this size. Bots can send documents of up to 50 MB
+# and a file may go over by one page, so the default leaves room for it.
+export_max_file_bytes = int(os.getenv("EXPORT_MAX_FILE_BYTES", str(45 * 1024 * 1024)))
+# Exports running at the same time in the process
+export_concurrency = int(os.getenv("EXPORT_CONCURRENCY", "2"))
+
+EXPORT_FORMATS = ("csv", "parquet")
+TAX_COLUMNS = (
+    "igv", "isc", "unaffected", "exonerated", "export", "free", "discount",
+    "others_charge", "others_taxes",
+)
+INVOICE_COLUMNS = (
+    "id", "id_invoice", "date", "time", "payment_date", "payment_method",
+    "currency_type", "category_type", "id_seller", "name_seller", "id_client",
+    "name_client", "address", "total", "recorded_operation", *TAX_COLUMNS,
+    "path_file",
+)
+DETAIL_COLUMNS = ("id", "invoice", "id_invoice", "product_name", "unit_price", "quantity")
+SUMMARY_COLUMNS = ("group", "key", "currency_type", "receipts", "subtotal", "taxes", "total")
+INTEGER_COLUMNS = {"id", "invoice", "receipts"}
+NUMERIC_COLUMNS = {"total", "recorded_operation", *TAX_COLUMNS, "unit_price", "quantity", "subtotal", "taxes"}
+
+export_slots = asyncio.Semaphore(export_concurrency)
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def parquet_schema(columns: tuple):
+    import pyarrow as pa
+    return pa.schema([
+        (column, pa.int64() if column in INTEGER_COLUMNS else pa.float64() if column in NUMERIC_COLUMNS else pa.string())
+        for column in columns
+    ])
+
+
+class PartWriter:
+    # Streams rows to name-1.csv, name-2.csv... and closes a part once it
+    # reaches max_bytes, so every file can be sent on its own.
+    def __init__(self, directory: Path, name: str, columns: tuple, export_format: str, max_bytes: int):
+        self.directory = directory
+        self.name = name
+        self.columns = columns
+        self.export_format = export_format
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self._parts = 0
+        self._path = None
+        self._file = None
+        self._writer = None
+
+    def _open(self) -> None:
+        self._parts += 1
+        self._path = self.directory / f"{self.name}-{self._parts}.{self.export_format}"
+        if self.export_format == "parquet":
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(str(self._path), parquet_schema(self.columns))
+        else:
+            self._file = open(self._path, "w", newline="", encoding="utf-8")
+            self._writer = csv.DictWriter(self._file, self.columns, extrasaction="ignore")
+            self._writer.writeheader()
+
+    def _size(self) -> int:
+        if self._file is not None:
+            return self._file.tell()
+        return self._path.stat().st_size
+
+    def write(self, rows: list) -> list:
+        # Returns the parts completed by this page
+        if not rows:
+            return []
+        if self._writer is None:
+            self._open()
+        if self.export_format == "parquet":
+            import pyarrow as pa
+            # Each page is a row group, written to disk right away
+            self._writer.write_table(pa.Table.from_pylist(rows, schema=parquet_schema(self.columns)))
+        else:
+            self._writer.writerows(rows)
+        self.rows += len(rows)
+        if self._size() >= self.max_bytes:
+            return self.close()
+        return []
+
+    def close(self) -> list:
+        if self._writer is None:
+            return []
+        if self._file is not None:
+            self._file.close()
+        else:
+            self._writer.close()
+        path, self._writer, self._file = self._path, None, None
+        return [path]
+
+
+class Totals:
+    # Receipts, subtotal, taxes and total by key and currency. Each page is
+    # grouped with numpy and only the sums of its groups are kept.
+    def __init__(self):
+        self.sums = {}
+
+    def add(self, keys: "np.ndarray", currencies: "np.ndarray", values: "np.ndarray") -> None:
+        import numpy as np
+        if not len(keys):
+            return
+        groups, inverse = np.unique(np.stack([keys, currencies], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(groups))
+        sums = np.stack(
+            [np.bincount(inverse, weights=values[:, column], minlength=len(groups)) for column in range(values.shape[1])],
+            axis=1,
+        )
+        page = np.column_stack([counts, sums])
+        for (key, currency), row in zip(groups.tolist(), page):
+            self.sums[(key, currency)] = self.sums.get((key, currency), 0) + row
+
+    def rows(self, group: str) -> list:
+        return [
+            {
+                "group": group,
+                "key": key,
+                "currency_type": currency,
+                "receipts": int(values[0]),
+                "subtotal": round(float(values[1]), 2),
+                "taxes": round(float(values[2]), 2),
+                "total": round(float(values[3]), 2),
+            }
+            for (key, currency), values in sorted(self.sums.items())
+        ]
+
+
+def column(rows: list, name: str) -> "np.ndarray":
+    # numpy, as pyarrow, is only loaded by the first export
+    import numpy as np
+    return np.array([str(row[name] or "") for row in rows], dtype=str)
+
+
+def amounts(rows: list) -> "np.ndarray":
+    # Same total as the confirmation message: products plus every tax except
+    # the recorded operation, see sum_all_taxes
+    import numpy as np
+    numbers = np.array([[row[name] or 0 for name in ("total", *TAX_COLUMNS)] for row in rows], dtype=float)
+    subtotal = numbers[:, 0]
+    taxes = numbers[:, 1:].sum(axis=1)
+    return np.stack([subtotal, taxes, subtotal + taxes], axis=1)
+
+
+class InvoiceExport:
+    # History of a user as "facturas" (one row per invoice), "productos" (one
+    # row per product) and "resumen" (totals by category and month) files.
+    # Pages are written as they arrive and dropped, so a long history does
+    # not fill the memory. The "invoice" column of a product is the "id" of
+    # its invoice.
+    def __init__(self, user_id: str, export_format: str, directory: Path):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {export_format}")
+        if export_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+            raise ExportUnavailable("Parquet export needs pyarrow installed")
+        self.user_id = user_id
+        self.export_format = export_format
+        self.directory = Path(directory)
+        self.invoices = PartWriter(self.directory, "facturas", INVOICE_COLUMNS, export_format, export_max_file_bytes)
+        self.products = PartWriter(self.directory, "productos", DETAIL_COLUMNS, export_format, export_max_file_bytes)
+        self.by_category = Totals()
+        self.by_month = Totals()
+
+    def _write_invoices(self, page: list) -> list:
+        values = amounts(page)
+        currencies = column(page, "currency_type")
+        self.by_category.add(column(page, "category_type"), currencies, values)
+        # "YYYY-MM" of the purchase date
+        self.by_month.add(column(page, "date").astype("U7"), currencies, values)
+        return self.invoices.write(page)
+
+    async def _products(self, invoice_ids: list):
+        for start in range(0, len(invoice_ids), export_detail_batch):
+            batch = invoice_ids[start:start + export_detail_batch]
+            after_id = 0
+            while True:
+                page = await fetch_invoice_details_page(batch, ",".join(DETAIL_COLUMNS), after_id, export_page_size)
+                if not page:
+                    break
+                yield page
+                if len(page) < export_page_size:
+                    break
+                after_id = page[-1]["id"]
+
+    async def files(self):
+        # Yields each file as soon as it is complete, so the first ones can be
+        # sent while the rest of the history is still being read
+        after_id = 0
+        while True:
+            page = await fetch_invoices_page(self.user_id, ",".join(INVOICE_COLUMNS), after_id, export_page_size)
+            if not page:
+                break
+            for path in await asyncio.to_thread(self._write_invoices, page):
+                yield path
+            async for products in self._products([row["id"] for row in page]):
+                for path in await asyncio.to_thread(self.products.write, products):
+                    yield path
+            if len(page) < export_page_size:
+                break
+            after_id = page[-1]["id"]
+        for path in self.invoices.close() + self.products.close():
+            yield path
+        if self.invoices.rows:
+            summary = PartWriter(self.directory, "resumen", SUMMARY_COLUMNS, self.export_format, export_max_file_bytes)
+            summary.write(self.by_category.rows("category") + self.by_month.rows("month"))
+            for path in summary.close():
+                yield path
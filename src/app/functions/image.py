@@ -0,0 +1,89 @@
+import io
+import os
+from PIL import Image, ImageFilter, ImageOps
+from functions.env import load_env
+
+load_env()
+
+# Variant sent to Gemini: the smaller it is, the fewer image tokens it costs
+image_max_side = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+image_jpeg_quality = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+image_grayscale = os.getenv("IMAGE_GRAYSCALE", "true").lower() == "true"
+image_autocrop = os.getenv("IMAGE_AUTOCROP", "true").lower() == "true"
+# Variant kept in Storage. ARCHIVE_MAX_SIDE=0 keeps the photo as it arrived.
+archive_max_side = int(os.getenv("ARCHIVE_MAX_SIDE", "1600"))
+archive_jpeg_quality = int(os.getenv("ARCHIVE_JPEG_QUALITY", "85"))
+
+
+def otsu_threshold(histogram: list) -> int:
+    total = sum(histogram)
+    sum_total = sum(level * count for level, count in enumerate(histogram))
+    sum_background = 0
+    weight_background = 0
+    best_threshold = 0
+    best_variance = 0
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_total - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_variance = variance
+            best_threshold = level
+    return best_threshold
+
+
+def document_bbox(image: Image.Image, margin: float = 0.02, min_area: float = 0.2):
+    # Receipts are bright paper over a darker background: threshold a small
+    # blurred copy and keep the bounding box of the bright region.
+    sample = image.convert("L")
+    sample.thumbnail((256, 256))
+    sample = sample.filter(ImageFilter.GaussianBlur(2))
+    threshold = otsu_threshold(sample.histogram())
+    bbox = sample.point(lambda value: 255 if value > threshold else 0).getbbox()
+    if bbox is None:
+        return None
+    scale_x = image.width / sample.width
+    scale_y = image.height / sample.height
+    left, top, right, bottom = bbox
+    left = max(0, int((left - margin * sample.width) * scale_x))
+    top = max(0, int((top - margin * sample.height) * scale_y))
+    right = min(image.width, int((right + margin * sample.width) * scale_x))
+    bottom = min(image.height, int((bottom + margin * sample.height) * scale_y))
+    if (right - left) * (bottom - top) < min_area * image.width * image.height:
+        return None
+    return left, top, right, bottom
+
+
+def encode_jpeg(image: Image.Image, max_side: int, quality: int) -> bytes:
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def normalize_image(image_bytes: bytes) -> tuple:
+    with Image.open(io.BytesIO(image_bytes)) as original:
+        image = ImageOps.exif_transpose(original)
+        if archive_max_side:
+            archive_bytes = encode_jpeg(image, archive_max_side, archive_jpeg_quality)
+        else:
+            archive_bytes = image_bytes
+        if image_autocrop:
+            bbox = document_bbox(image)
+            if bbox:
+                image = image.crop(bbox)
+        if image_grayscale:
+            image = image.convert("L")
+        ocr_bytes = encode_jpeg(image, image_max_side, image_jpeg_quality)
+    return ocr_bytes, archive_bytes
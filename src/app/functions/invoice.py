@@ -1,113 +1,218 @@
+import asyncio
+import logging
 import os
-from pathlib import Path
-from dotenv import load_dotenv
+import time
 import json
-from google import genai
 from datetime import datetime
-import pytz
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
+from functions.env import load_env
+from functions.partial_json import PartialJson
+from functions.metrics import record_tokens, span, timed
 
-dotenv_path = Path(__file__).resolve().parent.parent.parent.parent / ".env"
-load_dotenv(dotenv_path=dotenv_path)
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
+
+load_env()
 gemini_api_key = os.getenv("GEMINI_API_KEY")
+gemini_model = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Keep the instructions in a Gemini context cache. Off by default: Gemini
+# only caches contexts of at least GEMINI_PROMPT_CACHE_MIN_TOKENS tokens
+# (4096 for gemini-2.0-flash) and the current instructions are far below it.
+gemini_prompt_cache = os.getenv("GEMINI_PROMPT_CACHE", "false").lower() == "true"
+gemini_prompt_cache_min_tokens = int(os.getenv("GEMINI_PROMPT_CACHE_MIN_TOKENS", "4096"))
+# Lifetime of the cached instructions on Gemini, renewed when it expires
+gemini_prompt_cache_ttl = int(os.getenv("GEMINI_PROMPT_CACHE_TTL", "3600"))
+# Stream the answer so the bot can show the receipt while Gemini reads it
+gemini_streaming = os.getenv("GEMINI_STREAMING", "true").lower() == "true"
 
-tz = pytz.timezone('America/Lima')
-local_time = datetime.now(tz)
-
-
-def invoice_processing(path_file):
-    prompt = (
-        """
-        instrucciones: Tú eres el asistente administrativo de una empresa y te solicitan extraer la información relevante de la imagen 
-        de la boleta o factura, interpolar la categoria a la cual pertenece la factura según el tipo de factura que se especifica
-        en las indicaciones del formato de salida y debes retornar solo el objeto JSON con la siguiente estructura:
-        formato_de_salida: {
-            "tipo": "JSON",
-            "data": {
-                "id_invoice": string -> Identificación de la factura como número de serie,
-                "date": date -> Formato YYYY-MM-DD de la fecha de Emisión de la boleta y/o factura,
-                "time": time -> Formato HH:MM:SS de la fecha de Emisión de la boleta y/o factura,
-                "payment_date": string -> Formato YYYY-MM-DD de la fecha de pago de la boleta y/o factura,
-                "currency_type": string -> Tipo de moneda utilizada en la boleta y/o factura,
-                "category_type": string -> Tipo de factura puede ser 'ALIMENTACIÓN', 'TRANSPORTE',
-                'SERVICIOS BÁSICOS', 'SALUD', 'EDUCACIÓN', 'TECNOLOGÍA', 'ENTRETENIMIENTO', 'HOGAR Y OFICINA'
-                u 'OTROS',
-                "payment_method": string -> Formato de pago utilizado en la boleta y/o factura,
-                "seller": {
-                    "id_seller": string -> Identificación del vendedor como RUC o DNI,
-                    "name_seller": string -> Nombre de la empresa vendedora,
-                },
-                "client": {
-                    "id_client":string -> Identificación del cliente como RUC o DNI,
-                    "name_client": string -> Nombre del cliente o empresa que compra el producto y/o servicio también conocida como Razón Social,
-                    "address": string -> Dirección del cliente o empresa que compra el producto y/o servicio
-                },
-                "products": [
-                    {
-                        "product_name": string -> Nombre del producto,
-                        "unit_price": number -> Precio unitario del producto sin aplicar impuestos,
-                        "quantity": number -> Cantidad que el comprador está comprando del producto,
-                    }
-                    // Pueden haber más objetos de productos
-                ],
-                "taxes": {
-                    "recorded_operation": number -> Monto total de la Operación Gravada de la compra ,
-                    "igv": number -> Monto total de Impuesto General a las Ventas,
-                    "isc" : number -> Monto total del Impuesto Selectivo al Consumo,
-                    "unaffected": number -> Monto total de las Operaciones Inafectas,
-                    "exonerated": number -> Monto total de las Operaciones Exoneradas,
-                    "export": number -> Monto total de las Operaciones de exportación,
-                    "free": number -> Monto total de las Operaciones gratuitas,
-                    "discount": number -> Monto total del descuento,
-                    "others_charge": number -> Monto total de Otros cargos,
-                    "others_taxes": number -> Monto total de Otros Impuestos
-                }
-            }
-        }
-        consideraciones_adicionales: En caso un dato esté perdido o no se puede encontrar
-        para asignarlo al formato_de_salida debe colocarse 'null' en el value de la key a la
-        cual pertenezca. Asegúrate que los valores numéricos como el precio, cantidades,
-        subtotales, impuestos, totales, operaciones grabadas, operaciones inafectas,
-        operaciones exoneradas, operaciones de exportación, operación gratuita, total de
-        descuento, Impuesto Selectivo al Consumo o I.S.C., Impuesto General a la Ventas o I.G.V.,
-        otros cargos, otros tributos y el importe total. Recuerda que usualmente el primer nombre e identificación conocida como Razón Social
-        o Ruc que aparecen en las boletas o facturas pertenecen a la empresa vendedora.
-        Además, el cliente o empresa que compra el producto y/o servicio también tiene su Razón Social que es su nombre e
-        identificación que puede ser su número de D.N.I. o RUC. Debes verificar que los campos sean correctos para el cliente y la persona
-        o empresa que vende el producto o servicio, respectivamente.
-        Adicionalmente, se incluyen campos como 'Cajero', 'ID Cajero', 'DNI Cajero' o sus sinónimos no corresponden al nombre o identificación de la persona o empresa
-        compradora o vendero, solo representa a la persona encargada de la empresa vendedora que efectúa la transacción.
-        Con respecto a la construcción del array de objetos de productos, asegúrate que no se generen
-        duplicados en cuanto a los productos, dado que hay veces el nombre es muy largo y ocupa más de una fila.
-        En caso haya ítems de productos sin precio y cantidad, debes tomar en cuenta que estos no son productos, sino
-        subítems que suelen agregarse a los productos principales, cuyos precios y cantidades se encuentran en el mismo
-        objeto de productos. En este caso, debes verificar que el precio y cantidad sean correctos y concatenarlo en el mismo
-        nombre del producto principal.
-        """
-    )
-    client = genai.Client(api_key=gemini_api_key)
-    my_file = client.files.upload(file=path_file)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[my_file, prompt]
+tz = ZoneInfo("America/Lima")
+
+# The output format is declared by functions.schema.Invoice, so only the
+# extraction rules are sent as instructions.
+INSTRUCTIONS = (
+    """
+    instrucciones: Tú eres el asistente administrativo de una empresa y te solicitan extraer la información relevante de la imagen
+    de la boleta o factura, interpolar la categoria a la cual pertenece la factura según el tipo de factura y debes retornar
+    solo el objeto JSON con la estructura indicada.
+    consideraciones_adicionales: En caso un dato esté perdido o no se puede encontrar
+    para asignarlo al formato_de_salida debe colocarse 'null' en el value de la key a la
+    cual pertenezca. Asegúrate que los valores numéricos como el precio, cantidades,
+    subtotales, impuestos, totales, operaciones grabadas, operaciones inafectas,
+    operaciones exoneradas, operaciones de exportación, operación gratuita, total de
+    descuento, Impuesto Selectivo al Consumo o I.S.C., Impuesto General a la Ventas o I.G.V.,
+    otros cargos, otros tributos y el importe total. Recuerda que usualmente el primer nombre e identificación conocida como Razón Social
+    o Ruc que aparecen en las boletas o facturas pertenecen a la empresa vendedora.
+    Además, el cliente o empresa que compra el producto y/o servicio también tiene su Razón Social que es su nombre e
+    identificación que puede ser su número de D.N.I. o RUC. Debes verificar que los campos sean correctos para el cliente y la persona
+    o empresa que vende el producto o servicio, respectivamente.
+    Adicionalmente, se incluyen campos como 'Cajero', 'ID Cajero', 'DNI Cajero' o sus sinónimos no corresponden al nombre o identificación de la persona o empresa
+    compradora o vendero, solo representa a la persona encargada de la empresa vendedora que efectúa la transacción.
+    Con respecto a la construcción del array de objetos de productos, asegúrate que no se generen
+    duplicados en cuanto a los productos, dado que hay veces el nombre es muy largo y ocupa más de una fila.
+    En caso haya ítems de productos sin precio y cantidad, debes tomar en cuenta que estos no son productos, sino
+    subítems que suelen agregarse a los productos principales, cuyos precios y cantidades se encuentran en el mismo
+    objeto de productos. En este caso, debes verificar que el precio y cantidad sean correctos y concatenarlo en el mismo
+    nombre del producto principal.
+    """
+)
+REQUEST = "Extrae la información de la boleta y/o factura de la imagen."
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceProcessingError(Exception):
+    pass
+
+
+_gemini_client = None
+_prompt_cache = {"name": None, "expires_at": 0.0, "retry_at": 0.0}
+_prompt_cache_lock = asyncio.Lock()
+
+
+# The Gemini SDK and pydantic take most of the startup time of the bot, so
+# they are imported by the first function that needs them instead of here.
+def get_gemini_client() -> "genai.Client":
+    global _gemini_client
+    if _gemini_client is None:
+        from google import genai
+        _gemini_client = genai.Client(api_key=gemini_api_key)
+    return _gemini_client
+
+
+def prompt_cacheable() -> bool:
+    # About 4 characters per token: a create call that Gemini would reject
+    # for being too small is not even attempted
+    return gemini_prompt_cache and len(INSTRUCTIONS) / 4 >= gemini_prompt_cache_min_tokens
+
+
+@timed("gemini.prompt_cache")
+async def get_prompt_cache(client) -> str:
+    # Without a cache the instructions are sent as system_instruction. When
+    # creating it fails, it is tried again a TTL later.
+    if not prompt_cacheable():
+        return None
+    from google.genai import errors, types
+    async with _prompt_cache_lock:
+        now = time.monotonic()
+        if _prompt_cache["name"] and now < _prompt_cache["expires_at"]:
+            return _prompt_cache["name"]
+        if now < _prompt_cache["retry_at"]:
+            return None
+        try:
+            cached = await client.aio.caches.create(
+                model=gemini_model,
+                config=types.CreateCachedContentConfig(
+                    display_name="kooko-invoice-instructions",
+                    system_instruction=INSTRUCTIONS,
+                    ttl=f"{gemini_prompt_cache_ttl}s",
+                ),
+            )
+            _prompt_cache.update(name=cached.name, expires_at=now + gemini_prompt_cache_ttl - 60)
+        except errors.APIError as e:
+            logger.warning("No se pudo guardar las instrucciones en caché: %s", e)
+            _prompt_cache.update(name=None, retry_at=now + gemini_prompt_cache_ttl)
+        return _prompt_cache["name"]
+
+
+def generation_config(cached_content: str = None) -> "types.GenerateContentConfig":
+    from google.genai import types
+    from functions.schema import Invoice
+    config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=Invoice,
     )
-    metadata = {
+    if cached_content:
+        config.cached_content = cached_content
+    else:
+        config.system_instruction = INSTRUCTIONS
+    return config
+
+
+def usage_metadata(response) -> dict:
+    from google.genai import types
+    usage = response.usage_metadata or types.GenerateContentResponseUsageMetadata()
+    prompt = {item.modality: item.token_count or 0 for item in usage.prompt_tokens_details or []}
+    cached = {item.modality: item.token_count or 0 for item in usage.cache_tokens_details or []}
+    return {
         "input": {
-            "token_text": response.usage_metadata.prompt_tokens_details[0].token_count,
-            "token_image": response.usage_metadata.prompt_tokens_details[1].token_count,
+            "token_text": prompt.get(types.MediaModality.TEXT, 0) - cached.get(types.MediaModality.TEXT, 0),
+            "token_image": prompt.get(types.MediaModality.IMAGE, 0) - cached.get(types.MediaModality.IMAGE, 0),
+            "token_cached": usage.cached_content_token_count or 0,
         },
         "output": {
-            "token_text": response.usage_metadata.candidates_tokens_details[0].token_count,
+            "token_text": usage.candidates_token_count or 0,
         }
     }
+
+
+def parse_invoice(response) -> dict:
+    from functions.schema import Invoice
+    if isinstance(response.parsed, Invoice):
+        return response.parsed.model_dump()
+    try:
+        return json.loads(response.text.strip('`json\n').strip('`'))
+    except (TypeError, AttributeError, json.JSONDecodeError) as e:
+        raise InvoiceProcessingError(f"Gemini no devolvió un JSON válido: {e}") from e
+
+
+async def stream_invoice(client, contents: list, config: "types.GenerateContentConfig", on_progress) -> "types.GenerateContentResponse":
+    # on_progress receives the fields read so far every time a new one is
+    # complete. The chunks are joined back into a single response.
+    from google.genai import types
+    parser = PartialJson()
+    usage = None
+    async for chunk in await client.aio.models.generate_content_stream(
+        model=gemini_model,
+        contents=contents,
+        config=config,
+    ):
+        usage = chunk.usage_metadata or usage
+        partial = parser.feed(chunk.text or "")
+        if partial is not None:
+            on_progress(partial)
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=parser.text)]))],
+        usage_metadata=usage,
+    )
+
+
+@timed("gemini.generate")
+async def generate_invoice(client, contents: list, cached_content: str = None, on_progress=None) -> "types.GenerateContentResponse":
+    config = generation_config(cached_content)
+    if on_progress is not None and gemini_streaming:
+        return await stream_invoice(client, contents, config, on_progress)
+    return await client.aio.models.generate_content(
+        model=gemini_model,
+        contents=contents,
+        config=config,
+    )
+
+
+@timed("gemini.invoice_processing")
+async def invoice_processing(image_bytes: bytes, client=None, on_progress=None) -> dict:
+    from google.genai import errors, types
+    from functions.schema import validate_invoice
+    client = client or get_gemini_client()
+    # The image goes inline with the request, no separate Files API upload
+    image = types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
+    cached_content = await get_prompt_cache(client)
     try:
-        response_text = response.text
-        cleaned_str = response_text.strip('`json\n').strip('`')
-        result = json.loads(cleaned_str)
-        result.update(metadata)
-        return result
-    except json.JSONDecodeError as e:
-        print(f"Error al decodificar la cadena JSON: {e}")
-    return response
+        response = await generate_invoice(client, [image, REQUEST], cached_content, on_progress)
+    except errors.ClientError as e:
+        # Only a cache that expired or was deleted on Gemini's side (not
+        # found, or no longer ours) is worth a second call. Any other 4xx
+        # (a bad image, 429 for the scheduler) would fail again.
+        if not cached_content or e.code not in (403, 404):
+            raise
+        _prompt_cache.update(name=None, expires_at=0.0)
+        response = await generate_invoice(client, [image, REQUEST], on_progress=on_progress)
+    with span("gemini.parse"):
+        result = {"data": validate_invoice(parse_invoice(response), *generate_datetime())}
+    result.update(usage_metadata(response))
+    record_tokens(result)
+    return result
 
 
 def format_money(amount):
@@ -136,6 +241,7 @@ def sum_all_taxes(data):
 
 
 def generate_datetime():
-    date = local_time.strftime("%Y-%m-%d")
-    time = local_time.strftime("%H:%M:%S")
-    return date, time
+    # Read on every call: a value taken at import would be the same for
+    # every receipt of the process
+    now = datetime.now(tz)
+    return now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from functions.env import load_env
+
+load_env()
+job_queue_path = os.getenv(
+    "JOB_QUEUE_PATH",
+    str(Path(__file__).resolve().parent.parent.parent.parent / "jobs.sqlite3"),
+)
+job_queue_max_pending = int(os.getenv("JOB_QUEUE_MAX_PENDING", "500"))
+# Jobs of one user waiting or running, so one user cannot fill the queue
+job_queue_max_pending_per_user = int(os.getenv("JOB_QUEUE_MAX_PENDING_PER_USER", "50"))
+job_max_attempts = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+job_backoff_base = float(os.getenv("JOB_BACKOFF_BASE", "2"))
+job_backoff_max = float(os.getenv("JOB_BACKOFF_MAX", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UserQueueFull(QueueFull):
+    pass
+
+
+class RetryLater(Exception):
+    # Raised by a handler when the job cannot run yet (no quota, for
+    # example): it runs again after delay seconds without using an attempt
+    def __init__(self, delay: float):
+        super().__init__(f"Retry in {delay:.0f}s")
+        self.delay = delay
+
+
+class DurableQueue:
+    # Jobs live in SQLite from the moment they are enqueued until a worker
+    # finishes them, so a restart resumes them instead of losing them. A job
+    # that keeps failing is retried with exponential backoff and, after
+    # max_attempts, kept with status 'dead' and handed to on_dead. Workers
+    # take first the jobs of the users with the fewest jobs running, so one
+    # user sending many photos does not keep every worker busy.
+    def __init__(
+        self,
+        path: str,
+        max_pending: int,
+        max_pending_per_user: int,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+    ):
+        self.path = path
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._connection = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._workers = []
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(
+                """
+                PRAGMA journal_mode = WAL;
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    user_id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status_available_at ON jobs (status, available_at);
+                """
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+            if "user_id" not in columns:
+                # Queues created before jobs had a user
+                self._connection.execute("ALTER TABLE jobs ADD COLUMN user_id TEXT")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_user_id_status ON jobs (user_id, status)")
+        return self._connection
+
+    def _execute(self, query: str, params: tuple = ()) -> list:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                return connection.execute(query, params).fetchall()
+
+    def enqueue(self, payload: dict, user_id: str = None) -> int:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                pending, pending_of_user = connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(user_id IS ?), 0) FROM jobs WHERE status IN ('pending', 'running')",
+                    (user_id,),
+                ).fetchone()
+                if pending >= self.max_pending:
+                    raise QueueFull(f"{pending} jobs pending")
+                if user_id is not None and pending_of_user >= self.max_pending_per_user:
+                    raise UserQueueFull(f"{pending_of_user} jobs pending for the user")
+                cursor = connection.execute(
+                    "INSERT INTO jobs (payload, available_at, created_at, updated_at, user_id) VALUES (?, ?, ?, ?, ?)",
+                    (json.dumps(payload), now, now, now, user_id),
+                )
+                return cursor.lastrowid
+
+    def claim(self):
+        # The user with the fewest jobs running goes first, then the job
+        # that has been available the longest
+        now = time.time()
+        rows = self._execute(
+            """
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs AS job WHERE status = 'pending' AND available_at <= ?
+                ORDER BY (
+                    SELECT COUNT(*) FROM jobs AS running
+                    WHERE running.user_id IS job.user_id AND running.status = 'running'
+                ), available_at, id
+                LIMIT 1
+            )
+            RETURNING id, payload, attempts
+            """,
+            (now, now),
+        )
+        if not rows:
+            return None
+        job_id, payload, attempts = rows[0]
+        return job_id, json.loads(payload), attempts
+
+    def complete(self, job_id: int) -> None:
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def fail(self, job_id: int, attempts: int, error: str) -> bool:
+        now = time.time()
+        if attempts >= self.max_attempts:
+            self._execute(
+                "UPDATE jobs SET status = 'dead', last_error = ?, updated_at = ? WHERE id = ?",
+                (error, now, job_id),
+            )
+            return True
+        delay = min(self.backoff_max, self.backoff_base ** attempts) * random.uniform(0.5, 1.0)
+        self._execute(
+            "UPDATE jobs SET status = 'pending', available_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (now + delay, error, now, job_id),
+        )
+        return False
+
+    def postpone(self, job_id: int, delay: float, error: str) -> None:
+        # Gives back the attempt taken by claim()
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'pending', attempts = attempts - 1, available_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (now + max(delay, 0.0), error, now, job_id),
+        )
+
+    def recover(self) -> int:
+        # Jobs left 'running' belong to a process that stopped mid-way
+        rows = self._execute(
+            "UPDATE jobs SET status = 'pending', updated_at = ? WHERE status = 'running' RETURNING id",
+            (time.time(),),
+        )
+        return len(rows)
+
+    def counts(self) -> dict:
+        rows = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(rows)
+
+    async def put(self, payload: dict, user_id: str = None) -> int:
+        job_id = await asyncio.to_thread(self.enqueue, payload, user_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def _work(self, handler, on_dead, poll_interval: float) -> None:
+        while True:
+            job = await asyncio.to_thread(self.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, payload, attempts = job
+            try:
+                await handler(payload)
+            except asyncio.CancelledError:
+                # Left 'running' on purpose: recover() puts it back on restart
+                raise
+            except RetryLater as e:
+                logger.info("Trabajo %s pospuesto %.0fs: %r", job_id, e.delay, e.__cause__ or e)
+                await asyncio.to_thread(self.postpone, job_id, e.delay, repr(e.__cause__ or e))
+            except Exception as e:
+                logger.warning("Error en el trabajo %s (intento %s): %r", job_id, attempts, e, exc_info=e)
+                dead = await asyncio.to_thread(self.fail, job_id, attempts, repr(e))
+                if dead and on_dead is not None:
+                    try:
+                        await on_dead(payload)
+                    except Exception as e:
+                        logger.error("Error al notificar el trabajo fallido %s: %s", job_id, e)
+            else:
+                await asyncio.to_thread(self.complete, job_id)
+
+    async def start(self, handler, workers: int, on_dead=None, poll_interval: float = 1.0) -> None:
+        recovered = await asyncio.to_thread(self.recover)
+        if recovered:
+            logger.info("Se retomaron %s trabajos pendientes", recovered)
+        self._wakeup = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._work(handler, on_dead, poll_interval))
+            for _ in range(workers)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await asyncio.to_thread(self.recover)
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+receipt_queue = DurableQueue(
+    path=job_queue_path,
+    max_pending=job_queue_max_pending,
+    max_pending_per_user=job_queue_max_pending_per_user,
+    max_attempts=job_max_attempts,
+    backoff_base=job_backoff_base,
+    backoff_max=job_backoff_max,
+)
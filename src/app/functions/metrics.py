@@ -0,0 +1,121 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from functions.env import load_env
+
+load_env()
+# Prometheus endpoint, only on localhost by default. 0 turns it off.
+metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+# "text" or "json", one JSON object per line for log collectors
+log_format = os.getenv("LOG_FORMAT", "text")
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "kooko_stage_seconds",
+    "Time spent in each stage of the bot",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40),
+)
+ERRORS = Counter(
+    "kooko_errors_total",
+    "Errors by stage and exception type",
+    ["stage", "error"],
+)
+TOKENS = Histogram(
+    "kooko_gemini_tokens",
+    "Gemini tokens spent per receipt",
+    ["kind"],
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+IN_FLIGHT = Gauge(
+    "kooko_in_flight",
+    "Work in progress",
+    ["kind"],
+)
+QUEUED_JOBS = Gauge(
+    "kooko_queued_jobs",
+    "Jobs in the receipt queue by status",
+    ["status"],
+)
+QUALITY_REJECTIONS = Counter(
+    "kooko_quality_rejections_total",
+    "Photos that failed the quality checks, by reason",
+    ["reason"],
+)
+
+
+@contextmanager
+def span(stage: str, expected: tuple = ()):
+    # Times a block and counts its errors. A histogram observation costs a
+    # few microseconds, so every span stays on in production. Exceptions in
+    # expected (a photo turned away...) are outcomes, not errors.
+    start = time.perf_counter()
+    try:
+        yield
+    except expected:
+        raise
+    except Exception as e:
+        seconds = time.perf_counter() - start
+        ERRORS.labels(stage, type(e).__name__).inc()
+        logger.warning(
+            "Stage %s failed after %.3fs: %r", stage, seconds, e,
+            extra={"stage": stage, "error": repr(e), "seconds": seconds},
+        )
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def timed(stage: str):
+    # span() as a decorator, for sync and async functions
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(stage):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(stage):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_tokens(metadata: dict) -> None:
+    TOKENS.labels("input_text").observe(metadata["input"]["token_text"])
+    TOKENS.labels("input_image").observe(metadata["input"]["token_image"])
+    TOKENS.labels("input_cached").observe(metadata["input"]["token_cached"])
+    TOKENS.labels("output_text").observe(metadata["output"]["token_text"])
+
+
+def track_queue(counts) -> None:
+    # counts() is called on every scrape instead of on every job
+    for status in ("pending", "running", "dead"):
+        QUEUED_JOBS.labels(status).set_function(lambda status=status: counts().get(status, 0))
+
+
+def start_metrics_server() -> None:
+    if metrics_port:
+        start_http_server(metrics_port, addr=metrics_host)
+        logger.info("Metrics on http://%s:%s/metrics", metrics_host, metrics_port)
+
+
+def configure_logging(level: int = logging.INFO) -> None:
+    if log_format == "json":
+        from pythonjsonlogger.json import JsonFormatter
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        logging.basicConfig(level=level, handlers=[handler])
+    else:
+        logging.basicConfig(
+            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            level=level
+        )
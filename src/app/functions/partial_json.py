@@ -0,0 +1,58 @@
+import json
+
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class PartialJson:
+    # Reads a JSON document while it is still arriving. feed() returns what
+    # has been received so far, cut at the last point where the text is valid
+    # and with the open brackets closed. Objects inside an array are left out
+    # until they are complete, so a product never shows up half written.
+    def __init__(self):
+        self.text = ""
+        self._position = 0
+        self._stack = []
+        self._open_items = 0
+        self._in_string = False
+        self._escaped = False
+        self._cut = None
+        self._parsed_cut = None
+
+    def _mark_cut(self, end: int) -> None:
+        if self._open_items == 0:
+            closers = "".join(CLOSERS[bracket] for bracket, _ in reversed(self._stack))
+            self._cut = (end, closers)
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        for index in range(self._position, len(self.text)):
+            char = self.text[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                item = char == "{" and bool(self._stack) and self._stack[-1][0] == "["
+                self._stack.append((char, item))
+                self._open_items += item
+                self._mark_cut(index + 1)
+            elif char in "}]" and self._stack:
+                _, item = self._stack.pop()
+                self._open_items -= item
+                self._mark_cut(index + 1)
+            elif char == ",":
+                self._mark_cut(index)
+        self._position = len(self.text)
+        if self._cut is None or self._cut == self._parsed_cut:
+            return None
+        self._parsed_cut = self._cut
+        end, closers = self._cut
+        try:
+            return json.loads(self.text[:end] + closers)
+        except json.JSONDecodeError:
+            return None
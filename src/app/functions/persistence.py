@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from telegram.ext import BasePersistence, PersistenceInput
+from functions.env import load_env
+from functions.cache import TTLCache
+
+load_env()
+# "sqlite" keeps the sessions in a local file, "redis" in any server that
+# speaks the Redis protocol (Redis, Valkey, KeyDB...), shared by all replicas.
+session_store = os.getenv("SESSION_STORE", "sqlite")
+session_store_path = os.getenv(
+    "SESSION_STORE_PATH",
+    str(Path(__file__).resolve().parent.parent.parent.parent / "sessions.sqlite3"),
+)
+session_redis_url = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+# Sessions without activity for this long are forgotten
+session_ttl = float(os.getenv("SESSION_TTL", str(30 * 24 * 60 * 60)))
+session_cache_size = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+# Seconds a session is served from memory before it is read again from the store
+session_cache_ttl = float(os.getenv("SESSION_CACHE_TTL", "300"))
+session_flush_interval = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteSessionStore:
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # WAL lets the worker processes of the webhook mode share the file
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._connection.executescript(
+                """
+                PRAGMA journal_mode = WAL;
+                CREATE TABLE IF NOT EXISTS sessions (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+                """
+            )
+        return self._connection
+
+    def _get(self, user_id: int):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM sessions WHERE user_id = ? AND updated_at > ?",
+                (user_id, time.time() - self.ttl),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _set_many(self, sessions: dict) -> None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                    [(user_id, json.dumps(data), now) for user_id, data in sessions.items()],
+                )
+                connection.execute("DELETE FROM sessions WHERE updated_at <= ?", (now - self.ttl,))
+
+    def _delete(self, user_id: int) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    async def get(self, user_id: int):
+        return await asyncio.to_thread(self._get, user_id)
+
+    async def set_many(self, sessions: dict) -> None:
+        await asyncio.to_thread(self._set_many, sessions)
+
+    async def delete(self, user_id: int) -> None:
+        await asyncio.to_thread(self._delete, user_id)
+
+    async def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class RedisSessionStore:
+    # Works with any Redis-compatible server; only GET, SET EX and DEL are used
+    def __init__(self, url: str, ttl: float, prefix: str = "kooko:session:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("SESSION_STORE=redis requires the redis package: pip install redis") from e
+        self.client = redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    async def get(self, user_id: int):
+        data = await self.client.get(f"{self.prefix}{user_id}")
+        return None if data is None else json.loads(data)
+
+    async def set_many(self, sessions: dict) -> None:
+        async with self.client.pipeline(transaction=False) as pipeline:
+            for user_id, data in sessions.items():
+                pipeline.set(f"{self.prefix}{user_id}", json.dumps(data), ex=self.ttl)
+            await pipeline.execute()
+
+    async def delete(self, user_id: int) -> None:
+        await self.client.delete(f"{self.prefix}{user_id}")
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class SessionPersistence(BasePersistence):
+    # Keeps context.user_data (phone, registration and upload steps) in a
+    # store. Reads go through an in-memory cache, so only the first update of
+    # a user after a restart (or after cache_ttl) touches the store. Writes
+    # never block a handler: the Application hands over the changed sessions
+    # every update_interval and they are written in one batch.
+    def __init__(self, store, cache_size: int, cache_ttl: float, flush_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.store = store
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pending = {}
+        self._flushing = None
+
+    async def get_user_data(self) -> dict:
+        # Sessions are loaded on demand by refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._pending or self._cache.get(user_id) is not None:
+            return
+        stored = await self.store.get(user_id)
+        self._cache.set(user_id, True)
+        # Missing means new, expired or written by another replica before
+        user_data.clear()
+        if stored is not None:
+            user_data.update(stored)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending[user_id] = data
+        self._cache.set(user_id, True)
+        # The Application updates every changed user at once; they all land
+        # in _pending before this task runs and are written together.
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        if not self._pending:
+            return
+        sessions, self._pending = self._pending, {}
+        try:
+            await self.store.set_many(sessions)
+        except Exception as e:
+            logger.warning("Error al guardar %s sesiones: %s", len(sessions), e)
+            # Kept for the next batch unless the user changed again meanwhile
+            self._pending = {**sessions, **self._pending}
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._cache.pop(user_id)
+        await self.store.delete(user_id)
+
+    async def flush(self) -> None:
+        if self._flushing is not None:
+            await self._flushing
+        await self._write_pending()
+        await self.store.close()
+
+    # Only user_data is stored
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+def create_session_persistence() -> SessionPersistence:
+    if session_store == "redis":
+        store = RedisSessionStore(session_redis_url, session_ttl)
+    else:
+        store = SqliteSessionStore(session_store_path, session_ttl)
+    return SessionPersistence(
+        store,
+        cache_size=session_cache_size,
+        cache_ttl=session_cache_ttl,
+        flush_interval=session_flush_interval,
+    )
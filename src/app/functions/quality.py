@@ -0,0 +1,145 @@
+import io
+import logging
+import os
+from typing import TYPE_CHECKING
+from PIL import Image
+from functions.env import load_env
+from functions.image import otsu_threshold
+from functions.metrics import QUALITY_REJECTIONS
+
+if TYPE_CHECKING:
+    import numpy as np
+
+load_env()
+# "enforce" rejects unusable photos before Gemini, "monitor" only logs and
+# counts them (to calibrate on real traffic), "off" skips the checks. Only
+# enforce once the thresholds are calibrated on real photos.
+quality_gate = os.getenv("QUALITY_GATE", "monitor")
+# Longest side of the grayscale copy the checks run on
+quality_size = int(os.getenv("QUALITY_SIZE", "640"))
+# Mean gray level (0-255) below which the photo is too dark
+quality_min_brightness = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "40"))
+# Share of the photo in flat burnt out areas (tiles >= 250 as a whole), as
+# the reflection of a flash, above which the photo is overexposed. A white
+# background (a screenshot or a scan) is not counted.
+quality_max_clipped = float(os.getenv("QUALITY_MAX_CLIPPED", "0.1"))
+# Gray levels between the 1st and the 99th percentile: text on paper needs some
+quality_min_contrast = float(os.getenv("QUALITY_MIN_CONTRAST", "40"))
+# Variance of the Laplacian, low when the photo is out of focus or moved. It
+# is measured as if the contrast were stretched to 0-255, so a dim photo
+# that is in focus is not taken for a blurry one.
+quality_min_sharpness = float(os.getenv("QUALITY_MIN_SHARPNESS", "100"))
+# Share of the photo taken by the paper (the bright side of an Otsu split)
+quality_min_paper = float(os.getenv("QUALITY_MIN_PAPER", "0.1"))
+# Share of the paper with strong gradients (also on the stretched contrast),
+# the strokes of the printed text
+quality_min_text_edges = float(os.getenv("QUALITY_MIN_TEXT_EDGES", "0.01"))
+
+# Checked in this order, the first one that fails is the reason. A dark
+# photo is also blurry and edgeless, so exposure goes first.
+CHECKS = (
+    ("dark", "brightness", "min"),
+    ("overexposed", "clipped", "max"),
+    ("low_contrast", "contrast", "min"),
+    ("blurry", "sharpness", "min"),
+    ("not_document", "paper", "min"),
+    ("not_document", "text_edges", "min"),
+)
+THRESHOLDS = {
+    "brightness": quality_min_brightness,
+    "clipped": quality_max_clipped,
+    "contrast": quality_min_contrast,
+    "sharpness": quality_min_sharpness,
+    "paper": quality_min_paper,
+    "text_edges": quality_min_text_edges,
+}
+# Gradient (sum of the absolute differences to the right and below) of a
+# text stroke at the analysis size, on the stretched contrast
+TEXT_EDGE_GRADIENT = 48
+# Side, at the analysis size, of the tiles that have to be burnt out as a
+# whole to count as glare
+GLARE_TILE = 16
+
+logger = logging.getLogger(__name__)
+
+
+class UnusableImage(Exception):
+    def __init__(self, reason: str, measures: dict):
+        super().__init__(f"Unusable image: {reason}")
+        self.reason = reason
+        self.measures = measures
+
+
+def load_gray(image_bytes: bytes, size: int) -> "np.ndarray":
+    import numpy as np
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # JPEG photos are decoded straight at 1/2, 1/4 or 1/8 of their size
+        scale = min(1.0, size / max(image.size))
+        image.draft("L", (round(image.width * scale), round(image.height * scale)))
+        image = image.convert("L")
+        image.thumbnail((size, size))
+        return np.asarray(image)
+
+
+def image_measures(image_bytes: bytes, size: int = None) -> dict:
+    # numpy is loaded by the first photo, not when the bot starts
+    import numpy as np
+    gray = load_gray(image_bytes, size or quality_size)
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    cumulative = np.cumsum(histogram) / gray.size
+    contrast = int(np.searchsorted(cumulative, 0.99) - np.searchsorted(cumulative, 0.01))
+    stretch = 255 / max(contrast, 1)
+    # int16 holds every difference of uint8 values and is faster than floats
+    pixels = gray.astype(np.int16)
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    gradient = np.abs(np.diff(pixels, axis=1))[:-1, :] + np.abs(np.diff(pixels, axis=0))[:, :-1]
+    paper = gray[:-1, :-1] > otsu_threshold(histogram.tolist())
+    paper_pixels = int(np.count_nonzero(paper))
+    text_pixels = int(np.count_nonzero(gradient[paper] > TEXT_EDGE_GRADIENT / stretch))
+    # The paper of an e-receipt screenshot is 255 by itself, only burnt out
+    # areas on a paper that is not white are glare. A photo burnt out whole
+    # is left to the contrast check.
+    clipped = 0.0
+    if paper_pixels and np.median(gray[:-1, :-1][paper]) < 250:
+        rows, columns = gray.shape[0] // GLARE_TILE, gray.shape[1] // GLARE_TILE
+        tiles = gray[:rows * GLARE_TILE, :columns * GLARE_TILE].reshape(rows, GLARE_TILE, columns, GLARE_TILE)
+        clipped = float(np.count_nonzero(tiles.min(axis=(1, 3)) >= 250) / max(rows * columns, 1))
+    return {
+        "brightness": float(np.dot(np.arange(256), histogram) / gray.size),
+        "clipped": clipped,
+        "contrast": float(contrast),
+        "sharpness": float(laplacian.var() * stretch ** 2),
+        "paper": paper_pixels / paper.size,
+        "text_edges": text_pixels / paper_pixels if paper_pixels else 0.0,
+    }
+
+
+def quality_issue(measures: dict, thresholds: dict = None) -> str:
+    thresholds = thresholds or THRESHOLDS
+    for reason, measure, bound in CHECKS:
+        value, threshold = measures[measure], thresholds[measure]
+        if (value < threshold) if bound == "min" else (value > threshold):
+            return reason
+    return None
+
+
+def check_image(image_bytes: bytes) -> dict:
+    # Runs in a few milliseconds on the CPU, before any Gemini call. Raises
+    # UnusableImage when the photo should be taken again.
+    if quality_gate == "off":
+        return None
+    measures = image_measures(image_bytes)
+    reason = quality_issue(measures)
+    if reason is None:
+        return measures
+    QUALITY_REJECTIONS.labels(reason).inc()
+    logger.info(
+        "Unusable image (%s, gate %s): %s", reason, quality_gate, measures,
+        extra={"reason": reason, "measures": measures, "gate": quality_gate},
+    )
+    if quality_gate == "enforce":
+        raise UnusableImage(reason, measures)
+    return measures
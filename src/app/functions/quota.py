@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, defaultdict, deque
+from functions.env import load_env
+from functions.metrics import IN_FLIGHT, span
+
+load_env()
+# Quota of the Gemini project: requests and tokens (input + output) per minute
+gemini_rpm = float(os.getenv("GEMINI_RPM", "2000"))
+gemini_tpm = float(os.getenv("GEMINI_TPM", "4000000"))
+# Calls running at the same time overall and per user
+gemini_max_concurrent = int(os.getenv("RECEIPT_CONCURRENCY", "8"))
+gemini_user_max_in_flight = int(os.getenv("GEMINI_USER_MAX_IN_FLIGHT", "2"))
+# Longest a receipt waits for its turn before the job is retried later
+gemini_max_wait = float(os.getenv("GEMINI_MAX_WAIT", "60"))
+# Tokens charged up front for a call, corrected with the real usage after
+gemini_estimated_tokens = float(os.getenv("GEMINI_ESTIMATED_TOKENS", "1500"))
+gemini_max_retries = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+gemini_backoff_base = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+gemini_backoff_max = float(os.getenv("GEMINI_BACKOFF_MAX", "60"))
+# A second call is started when the first one is slower than the p95 of the
+# recent ones (and at least GEMINI_HEDGE_MIN_DELAY seconds), if quota allows.
+# Off by default: Gemini bills the call that loses, and only the quota
+# accounts for it, not user_credits.
+gemini_hedge = os.getenv("GEMINI_HEDGE", "false").lower() == "true"
+gemini_hedge_min_delay = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "5"))
+
+THROTTLED_CODES = (429, 503)
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiBusy(Exception):
+    def __init__(self, wait: float):
+        super().__init__(f"Gemini quota exhausted, estimated wait {wait:.0f}s")
+        self.wait = wait
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_for(self, amount: float) -> float:
+        self._refill()
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def wait_time(self, amount: float) -> float:
+        # A single call larger than the bucket only waits for it to be full
+        return self.time_for(min(amount, self.capacity))
+
+    def take(self, amount: float) -> None:
+        # May go below zero when the real usage exceeds the estimate
+        self._refill()
+        self.level -= amount
+
+
+def tokens_used(result: dict) -> float:
+    return (
+        result["input"]["token_text"]
+        + result["input"]["token_image"]
+        + result["input"]["token_cached"]
+        + result["output"]["token_text"]
+    )
+
+
+class GeminiScheduler:
+    # Admission control in front of Gemini. Calls wait until both the request
+    # and the token budget allow them, users take turns (round robin) so one
+    # user sending many photos cannot starve the rest, 429/503 answers pause
+    # every call with exponential backoff, and slow calls are hedged. A call
+    # first waits behind the user's own calls (user_max_in_flight at a time)
+    # and only then for the quota, which is the only wait bounded by max_wait.
+    def __init__(
+        self,
+        rpm: float,
+        tpm: float,
+        max_concurrent: int,
+        user_max_in_flight: int,
+        max_wait: float,
+        estimated_tokens: float,
+        max_retries: int,
+        backoff_base: float,
+        backoff_max: float,
+        hedge: bool,
+        hedge_min_delay: float,
+    ):
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.max_concurrent = max_concurrent
+        self.user_max_in_flight = user_max_in_flight
+        self.max_wait = max_wait
+        self.estimated_tokens = estimated_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self._waiting = OrderedDict()
+        self._users = {}
+        self._in_flight = defaultdict(int)
+        self._running = 0
+        self._paused_until = 0.0
+        self._throttled = 0
+        self._timer = None
+        self._latencies = deque(maxlen=200)
+
+    def waiting(self) -> int:
+        return sum(len(futures) for futures in self._waiting.values())
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        while self._waiting and self._running < self.max_concurrent:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                self._schedule(pause)
+                return
+            user_id = next(
+                (user_id for user_id in self._waiting if self._in_flight.get(user_id, 0) < self.user_max_in_flight),
+                None,
+            )
+            if user_id is None:
+                return
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(self.estimated_tokens))
+            if wait > 0:
+                self._schedule(wait)
+                return
+            self.requests.take(1)
+            self.tokens.take(self.estimated_tokens)
+            futures = self._waiting.pop(user_id)
+            future = futures.popleft()
+            if futures:
+                # Back of the line: the other users go first
+                self._waiting[user_id] = futures
+            self._in_flight[user_id] += 1
+            self._running += 1
+            future.set_result(None)
+
+    def estimated_wait(self) -> float:
+        ahead = self.waiting()
+        return max(
+            self._paused_until - time.monotonic(),
+            self.requests.time_for(ahead),
+            self.tokens.time_for(ahead * self.estimated_tokens),
+        )
+
+    def _forget(self, user_id, future: asyncio.Future) -> None:
+        futures = self._waiting.get(user_id)
+        if futures and future in futures:
+            futures.remove(future)
+            if not futures:
+                del self._waiting[user_id]
+
+    async def _user_turn(self, user_id) -> None:
+        # No deadline here: these calls are behind the user's other photos,
+        # not behind the quota, and an album must not lose photos for it
+        turns, holders = self._users.get(user_id, (asyncio.Semaphore(self.user_max_in_flight), 0))
+        self._users[user_id] = (turns, holders + 1)
+        try:
+            await turns.acquire()
+        except BaseException:
+            self._leave(user_id, acquired=False)
+            raise
+
+    def _leave(self, user_id, acquired: bool = True) -> None:
+        turns, holders = self._users[user_id]
+        if acquired:
+            turns.release()
+        if holders == 1:
+            del self._users[user_id]
+        else:
+            self._users[user_id] = (turns, holders - 1)
+
+    async def acquire(self, user_id, on_wait=None) -> None:
+        await self._user_turn(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self._dispatch()
+        if future.done():
+            return
+        wait = self.estimated_wait()
+        if wait > self.max_wait:
+            self._forget(user_id, future)
+            self._leave(user_id)
+            raise GeminiBusy(wait)
+        if on_wait is not None:
+            on_wait(wait)
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(user_id)
+            else:
+                self._forget(user_id, future)
+                self._leave(user_id)
+            raise
+        if not done:
+            self._forget(user_id, future)
+            self._leave(user_id)
+            raise GeminiBusy(self.estimated_wait())
+
+    def release(self, user_id, used: float = None) -> None:
+        self._leave(user_id)
+        self._in_flight[user_id] -= 1
+        if not self._in_flight[user_id]:
+            del self._in_flight[user_id]
+        self._running -= 1
+        if used is not None:
+            # Settle the estimate with the real usage and learn from it
+            self.tokens.take(used - self.estimated_tokens)
+            self.estimated_tokens = 0.8 * self.estimated_tokens + 0.2 * used
+        self._dispatch()
+
+    def _back_off(self) -> None:
+        self._throttled += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** self._throttled) * random.uniform(0.5, 1.0)
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _hedge_delay(self):
+        if not self.hedge or len(self._latencies) < 20:
+            return None
+        latencies = sorted(self._latencies)
+        return max(self.hedge_min_delay, latencies[int(len(latencies) * 0.95)])
+
+    async def _call(self, call, hedge: bool):
+        delay = self._hedge_delay() if hedge else None
+        start = time.monotonic()
+        first = asyncio.create_task(call())
+        tasks = {first}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                no_budget = self.requests.wait_time(1) or self.tokens.wait_time(self.estimated_tokens)
+                if not done and not no_budget:
+                    self.requests.take(1)
+                    self.tokens.take(self.estimated_tokens)
+                    tasks.add(asyncio.create_task(call()))
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                task = done.pop()
+                # A failed call only counts if there is no other one left
+                if task.exception() is None or not tasks:
+                    result = task.result()
+                    self._latencies.append(time.monotonic() - start)
+                    return result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self, user_id, call, on_wait=None, hedge: bool = True):
+        # call() starts a new Gemini request and returns its result dict.
+        # hedge=False for streaming calls: a second call would start showing
+        # the receipt from scratch. The SDK is imported on first use, not
+        # when the bot starts.
+        from google.genai import errors
+        for attempt in range(self.max_retries + 1):
+            with span("gemini.admission"):
+                await self.acquire(user_id, on_wait)
+            try:
+                with IN_FLIGHT.labels("gemini").track_inprogress():
+                    result = await self._call(call, hedge)
+            except errors.APIError as e:
+                self.release(user_id)
+                if e.code not in THROTTLED_CODES or attempt == self.max_retries:
+                    raise
+                logger.info("Gemini respondió %s, se reintenta: %s", e.code, e)
+                self._back_off()
+                continue
+            except BaseException:
+                self.release(user_id)
+                raise
+            self._throttled = 0
+            self.release(user_id, tokens_used(result))
+            return result
+
+
+gemini_scheduler = GeminiScheduler(
+    rpm=gemini_rpm,
+    tpm=gemini_tpm,
+    max_concurrent=gemini_max_concurrent,
+    user_max_in_flight=gemini_user_max_in_flight,
+    max_wait=gemini_max_wait,
+    estimated_tokens=gemini_estimated_tokens,
+    max_retries=gemini_max_retries,
+    backoff_base=gemini_backoff_base,
+    backoff_max=gemini_backoff_max,
+    hedge=gemini_hedge,
+    hedge_min_delay=gemini_hedge_min_delay,
+)
@@ -0,0 +1,96 @@
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
+
+# Structure Gemini must answer with. It is passed as response_schema, so the
+# descriptions below replace the output format that used to live in the prompt.
+# Gemini does not accept default values in a response schema: every field is
+# Optional and missing values arrive as null and are filled by validate_invoice.
+
+CategoryType = Literal[
+    "ALIMENTACIÓN",
+    "TRANSPORTE",
+    "SERVICIOS BÁSICOS",
+    "SALUD",
+    "EDUCACIÓN",
+    "TECNOLOGÍA",
+    "ENTRETENIMIENTO",
+    "HOGAR Y OFICINA",
+    "OTROS",
+]
+
+
+class Seller(BaseModel):
+    id_seller: Optional[str] = Field(description="Identificación del vendedor como RUC o DNI")
+    name_seller: Optional[str] = Field(description="Nombre de la empresa vendedora")
+
+
+class Client(BaseModel):
+    id_client: Optional[str] = Field(description="Identificación del cliente como RUC o DNI")
+    name_client: Optional[str] = Field(
+        description="Nombre del cliente o empresa que compra el producto y/o servicio también conocida como Razón Social"
+    )
+    address: Optional[str] = Field(description="Dirección del cliente o empresa que compra el producto y/o servicio")
+
+
+class Product(BaseModel):
+    product_name: Optional[str] = Field(description="Nombre del producto")
+    unit_price: Optional[float] = Field(description="Precio unitario del producto sin aplicar impuestos")
+    quantity: Optional[float] = Field(description="Cantidad que el comprador está comprando del producto")
+
+
+class Taxes(BaseModel):
+    recorded_operation: Optional[float] = Field(description="Monto total de la Operación Gravada de la compra")
+    igv: Optional[float] = Field(description="Monto total de Impuesto General a las Ventas")
+    isc: Optional[float] = Field(description="Monto total del Impuesto Selectivo al Consumo")
+    unaffected: Optional[float] = Field(description="Monto total de las Operaciones Inafectas")
+    exonerated: Optional[float] = Field(description="Monto total de las Operaciones Exoneradas")
+    export: Optional[float] = Field(description="Monto total de las Operaciones de exportación")
+    free: Optional[float] = Field(description="Monto total de las Operaciones gratuitas")
+    discount: Optional[float] = Field(description="Monto total del descuento")
+    others_charge: Optional[float] = Field(description="Monto total de Otros cargos")
+    others_taxes: Optional[float] = Field(description="Monto total de Otros Impuestos")
+
+
+class Invoice(BaseModel):
+    id_invoice: Optional[str] = Field(description="Identificación de la factura como número de serie")
+    date: Optional[str] = Field(description="Fecha de emisión de la boleta y/o factura en formato YYYY-MM-DD")
+    time: Optional[str] = Field(description="Hora de emisión de la boleta y/o factura en formato HH:MM:SS")
+    payment_date: Optional[str] = Field(description="Fecha de pago de la boleta y/o factura en formato YYYY-MM-DD")
+    currency_type: Optional[str] = Field(description="Tipo de moneda utilizada en la boleta y/o factura")
+    category_type: Optional[CategoryType] = Field(description="Categoría a la que pertenece la boleta y/o factura")
+    payment_method: Optional[str] = Field(description="Forma de pago utilizada en la boleta y/o factura")
+    seller: Optional[Seller]
+    client: Optional[Client]
+    products: Optional[list[Product]]
+    taxes: Optional[Taxes]
+
+
+STRING_FIELDS = ("id_invoice", "currency_type", "category_type", "payment_method")
+SELLER_FIELDS = ("id_seller", "name_seller")
+CLIENT_FIELDS = ("id_client", "name_client", "address")
+PRODUCT_FIELDS = ("product_name", "unit_price", "quantity")
+
+
+def validate_invoice(data: dict, date: str, time: str) -> dict:
+    # Fills what build_invoice_row and the confirmation message expect:
+    # empty strings, zero amounts and the current date and time.
+    invoice = {key: data.get(key) or "" for key in STRING_FIELDS}
+    invoice["date"] = data.get("date") or date
+    invoice["time"] = data.get("time") or time
+    invoice["payment_date"] = data.get("payment_date") or date
+    seller = data.get("seller") or {}
+    invoice["seller"] = {key: seller.get(key) or "" for key in SELLER_FIELDS}
+    client = data.get("client") or {}
+    invoice["client"] = {key: client.get(key) or "" for key in CLIENT_FIELDS}
+    invoice["products"] = [
+        {
+            "product_name": product.get("product_name") or "",
+            "unit_price": product.get("unit_price") or 0,
+            "quantity": product.get("quantity") or 0,
+        }
+        for product in data.get("products") or []
+        if any(product.get(key) for key in PRODUCT_FIELDS)
+    ]
+    taxes = data.get("taxes") or {}
+    invoice["taxes"] = {key: taxes.get(key) or 0 for key in Taxes.model_fields}
+    return invoice
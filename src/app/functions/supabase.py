@@ -1,56 +1,112 @@
+import asyncio
+import logging
 import os
-from pathlib import Path
-from dotenv import load_dotenv
-from supabase import create_client, Client
-from supabase.client import ClientOptions
 from datetime import datetime
-import pytz
-from functions.invoice import generate_datetime
+from typing import TYPE_CHECKING
+from functions.env import load_env
+from functions.invoice import generate_datetime, tz
+from functions.cache import TTLCache
+from functions.metrics import timed
 
-dotenv_path = Path(__file__).resolve().parent.parent.parent.parent / ".env"
-load_dotenv(dotenv_path=dotenv_path)
+if TYPE_CHECKING:
+    from functions.supabase_pool import PooledSupabaseClient
+
+load_env()
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_anon_key = os.getenv("SUPABASE_ANON_KEY")
 
+# Phone -> user_id lookups of verify_user. Unknown numbers are remembered for
+# a shorter time so a user who just signed up is not rejected for long.
+user_cache_size = int(os.getenv("USER_CACHE_SIZE", "10000"))
+user_cache_ttl = float(os.getenv("USER_CACHE_TTL", "600"))
+user_cache_negative_ttl = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "30"))
+
+_supabase_client = None
+_supabase_client_lock = asyncio.Lock()
+_user_cache = TTLCache(user_cache_size, user_cache_ttl)
+_missing = object()
+
+logger = logging.getLogger(__name__)
+
 
-tz = pytz.timezone('America/Lima')
-local_time = datetime.now(tz)
+async def get_supabase_client() -> "PooledSupabaseClient":
+    global _supabase_client
+    if _supabase_client is None:
+        async with _supabase_client_lock:
+            if _supabase_client is None:
+                # The Supabase SDK is loaded with the first client, not at import
+                from functions.supabase_pool import create_supabase_client
+                _supabase_client = await create_supabase_client(supabase_url, supabase_anon_key)
+    return _supabase_client
 
 
-def create_supabase_client() -> Client:
-    return create_client(
-        supabase_url,
-        supabase_anon_key,
-        options=ClientOptions(
-            postgrest_client_timeout=10,
-            storage_client_timeout=10,
-            schema="public",
+@timed("supabase.check_supabase_health")
+async def check_supabase_health() -> bool:
+    try:
+        supabase = await get_supabase_client()
+        await (
+            supabase.table("users")
+            .select("user_id")
+            .limit(1)
+            .execute()
         )
-    )
+        return True
+    except Exception as e:
+        logger.warning("Error al verificar la conexión con Supabase: %s", e)
+        return False
+
+
+async def close_supabase_client() -> None:
+    global _supabase_client
+    if _supabase_client is None:
+        return
+    supabase, _supabase_client = _supabase_client, None
+    if supabase._postgrest is not None:
+        await supabase._postgrest.aclose()
+    if supabase._storage is not None:
+        await supabase._storage.aclose()
 
 
-def verify_user(user_phone: str) -> str:
-    supabase = create_supabase_client()
-    response = (
+@timed("supabase.verify_user")
+async def verify_user(user_phone: str) -> str:
+    user_id = _user_cache.get(user_phone, _missing)
+    if user_id is not _missing:
+        return user_id
+    supabase = await get_supabase_client()
+    response = await (
         supabase.table("users")
         .select("user_id")
         .eq("user_phone", user_phone)
         .execute()
     )
     if response.data:
-        return response.data[0]["user_id"]
+        user_id = response.data[0]["user_id"]
+        _user_cache.set(user_phone, user_id)
     else:
-        return None
+        user_id = None
+        _user_cache.set(user_phone, user_id, ttl=user_cache_negative_ttl)
+    return user_id
+
+
+def invalidate_user(user_phone: str) -> None:
+    _user_cache.pop(user_phone)
+
 
+async def warm_user(user_phone: str) -> None:
+    try:
+        await verify_user(user_phone)
+    except Exception as e:
+        logger.warning("Error al precargar el usuario: %s", e)
 
-def insert_invoice_data(
+
+def build_invoice_row(
     user_id: str,
     total: float,
     invoice_data: dict,
     path_file: str
-) -> None:
+) -> dict:
     date, time = generate_datetime()
-    data = {
+    return {
         "user_id": user_id,
         "id_invoice": invoice_data["id_invoice"] or "",
         "payment_date": invoice_data["payment_date"] or date,
@@ -77,21 +133,9 @@ def insert_invoice_data(
         "others_taxes": invoice_data["taxes"]["others_taxes"] or 0,
         "path_file": path_file or "",
     }
-    supabase = create_supabase_client()
-    response = (
-        supabase.table("invoices")
-        .insert(data)
-        .execute()
-    )
-    if response.data:
-        return response.data
-    else:
-        return None
 
 
-def insert_invoice_detail_data(
-    invoice_detail_data: dict,
-) -> None:
+def build_invoice_detail_rows(invoice_detail_data: dict) -> list:
     products = invoice_detail_data["products"]
     data = []
     for item in products:
@@ -101,54 +145,163 @@ def insert_invoice_detail_data(
             "unit_price": item["unit_price"],
             "quantity": item["quantity"],
         })
-    supabase = create_supabase_client()
-    response = (
-        supabase.table("invoices_detail")
-        .insert(data)
-        .execute()
-    )
-    if response.data:
-        return response.data
-    else:
-        return None
+    return data
 
 
-def insert_user_credits_data(
-    user_id: str,
-    credits: dict,
-) -> None:
-    data = {
+def build_user_credits_row(user_id: str, credits: dict) -> dict:
+    return {
         "user_id": user_id,
         "input_token_text": credits["input"]["token_text"],
         "input_token_image": credits["input"]["token_image"],
         "output_token_text": credits["output"]["token_text"],
     }
-    supabase = create_supabase_client()
-    response = (
+
+
+@timed("supabase.insert_user_credits_rows")
+async def insert_user_credits_rows(rows: list) -> None:
+    # Bulk version used by the credits buffer: one request for many receipts
+    from postgrest.types import ReturnMethod
+    supabase = await get_supabase_client()
+    await (
         supabase.table("user_credits")
-        .insert(data)
+        .insert(rows, returning=ReturnMethod.minimal)
         .execute()
     )
-    if response.data:
-        return response.data
+
+
+@timed("supabase.fetch_invoices_page")
+async def fetch_invoices_page(user_id: str, columns: str, after_id: int, limit: int) -> list:
+    # Keyset pagination: every page is an index range scan after the last id,
+    # as fast for the 100th page as for the first one, unlike an offset
+    supabase = await get_supabase_client()
+    response = await (
+        supabase.table("invoices")
+        .select(columns)
+        .eq("user_id", user_id)
+        .gt("id", after_id)
+        .order("id")
+        .limit(limit)
+        .execute()
+    )
+    return response.data
+
+
+@timed("supabase.fetch_invoice_details_page")
+async def fetch_invoice_details_page(invoice_ids: list, columns: str, after_id: int, limit: int) -> list:
+    # By the id of the invoice rows, never by their number: numbers repeat
+    # across stores and users
+    supabase = await get_supabase_client()
+    response = await (
+        supabase.table("invoices_detail")
+        .select(columns)
+        .in_("invoice", invoice_ids)
+        .gt("id", after_id)
+        .order("id")
+        .limit(limit)
+        .execute()
+    )
+    return response.data
+
+
+def invoice_storage_path(user_id: str, index: int = 0, at: datetime = None) -> str:
+    # Receipts of the same album share the timestamp, the index tells them apart
+    suffix = f"-{index}" if index else ""
+    at = at or datetime.now(tz)
+    return f"public/{user_id}-{at.strftime("%Y%m%d%H%M%S%f")}{suffix}.jpg"
+
+
+@timed("supabase.upload_file")
+async def upload_file(image_bytes: bytes, user_id: str, path: str = None) -> None:
+    supabase = await get_supabase_client()
+    response = await (
+        supabase.storage
+        .from_("invoices")
+        .upload(
+            file=image_bytes,
+            path=path or invoice_storage_path(user_id),
+            file_options={"cache-control": "3600",
+                          "upsert": "false", "content-type": "image/jpg"}
+        )
+    )
+    if response.fullPath:
+        return response.path
     else:
         return None
 
 
-def upload_file(file_path: str, user_id: str) -> None:
-    supabase = create_supabase_client()
-    with open(file_path, "rb") as file:
-        response = (
-            supabase.storage
-            .from_("invoices")
-            .upload(
-                file=file,
-                path=f"public/{user_id}-{local_time.strftime("%Y%m%d%H%M%S%f")}.jpg",
-                file_options={"cache-control": "3600",
-                              "upsert": "false", "content-type": "image/jpg"}
-            )
-        )
-        if response.fullPath:
-            return response.path
-        else:
-            return None
+@timed("supabase.remove_files")
+async def remove_files(paths: list) -> None:
+    supabase = await get_supabase_client()
+    await supabase.storage.from_("invoices").remove(paths)
+
+
+@timed("supabase.insert_invoices")
+async def insert_invoices(items: list) -> list:
+    supabase = await get_supabase_client()
+    response = await supabase.rpc("insert_invoices", {"p_invoices": items}).execute()
+    return response.data
+
+
+@timed("supabase.delete_invoices")
+async def delete_invoices(user_id: str, ids: list) -> None:
+    # Raises if any of the invoices is not the user's or is already gone
+    supabase = await get_supabase_client()
+    await supabase.rpc("delete_invoices", {"p_user_id": user_id, "p_ids": ids}).execute()
+
+
+def already_uploaded(error) -> bool:
+    # Storage answers an upload to a path that is taken with statusCode 409
+    return isinstance(error, Exception) and str(getattr(error, "status", "")) == "409"
+
+
+@timed("supabase.save_invoices")
+async def save_invoices(user_id: str, receipts: list, key: str = None, at: datetime = None) -> list:
+    # Each receipt is a dict with the total, invoice_data, image_bytes and
+    # credits of one invoice, and optionally its "index" among the photos.
+    # The storage paths are decided up front so the rows can reference the
+    # files while they are still being uploaded. All the rows go in one
+    # transactional RPC (see supabase/migrations), and whichever side
+    # succeeds is undone if the other one fails.
+    #
+    # With a key (the same on every run of a job) and the time the job was
+    # created, saving again is harmless: the paths are the same, a file that
+    # is already there was uploaded by an earlier run (uploads do not upsert,
+    # which would need UPDATE policies on the bucket) and insert_invoices
+    # returns the rows it already has. The files are then kept when the RPC
+    # fails, since it may have committed anyway and a retry will point to
+    # them again.
+    at = at or datetime.now(tz)
+    indexes = [receipt.get("index", position) for position, receipt in enumerate(receipts)]
+    paths = [invoice_storage_path(user_id, index, at) for index in indexes]
+    items = [
+        {
+            "invoice": build_invoice_row(user_id, receipt["total"], receipt["invoice_data"], path),
+            "details": build_invoice_detail_rows(receipt["invoice_data"]),
+            "credits": build_user_credits_row(user_id, receipt["credits"]) if receipt.get("credits") else None,
+            "key": f"{key}-{index}" if key else None,
+        }
+        for receipt, path, index in zip(receipts, paths, indexes)
+    ]
+    *uploaded, inserted = await asyncio.gather(
+        *(
+            upload_file(receipt["image_bytes"], user_id=user_id, path=path)
+            for receipt, path in zip(receipts, paths)
+        ),
+        insert_invoices(items),
+        return_exceptions=True,
+    )
+    if key is not None:
+        uploaded = [None if already_uploaded(result) else result for result in uploaded]
+    stored = [path for path, result in zip(paths, uploaded) if not isinstance(result, BaseException)]
+    failed = [result for result in uploaded if isinstance(result, BaseException)]
+    if isinstance(inserted, BaseException):
+        if stored and key is None:
+            await remove_files(stored)
+        raise inserted
+    if failed:
+        await delete_invoices(user_id, inserted)
+        if stored:
+            await remove_files(stored)
+        raise failed[0]
+    return inserted
+
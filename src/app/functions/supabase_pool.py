@@ -0,0 +1,81 @@
+import os
+import httpx
+from supabase import AsyncClient, AsyncClientOptions
+from postgrest import AsyncPostgrestClient
+from storage3 import AsyncStorageClient
+from functions.env import load_env
+
+load_env()
+# Connection pool shared by every PostgREST and Storage request of the process
+supabase_max_connections = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+supabase_max_keepalive = int(os.getenv("SUPABASE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+supabase_keepalive_expiry = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "60"))
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=supabase_max_connections,
+        max_keepalive_connections=supabase_max_keepalive,
+        keepalive_expiry=supabase_keepalive_expiry,
+    )
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=pool_limits(),
+        )
+
+
+class PooledStorageClient(AsyncStorageClient):
+    def _create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=bool(verify),
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=pool_limits(),
+        )
+
+
+class PooledSupabaseClient(AsyncClient):
+    # The parent builds PostgREST and Storage lazily and keeps them for the
+    # life of the client, so swapping the classes is enough to pool them.
+    @staticmethod
+    def _init_postgrest_client(rest_url, headers, schema, timeout, verify=True, proxy=None):
+        return PooledPostgrestClient(
+            rest_url,
+            headers=headers,
+            schema=schema,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+        )
+
+    @staticmethod
+    def _init_storage_client(storage_url, headers, storage_client_timeout, verify=True, proxy=None):
+        return PooledStorageClient(
+            storage_url, headers, storage_client_timeout, verify, proxy
+        )
+
+
+async def create_supabase_client(url: str, key: str) -> PooledSupabaseClient:
+    return await PooledSupabaseClient.create(
+        url,
+        key,
+        options=AsyncClientOptions(
+            postgrest_client_timeout=10,
+            storage_client_timeout=10,
+            schema="public",
+        )
+    )
@@ -0,0 +1,57 @@
+import asyncio
+import sys
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Updates of different chats run concurrently, updates of the same chat
+    # run one after another in the order they arrived. An update first waits
+    # for the turn of its chat and only then for one of the
+    # max_concurrent_updates slots, so a busy chat holds a single slot while
+    # its other updates wait, instead of stalling every chat.
+    def __init__(self, max_concurrent_updates: int):
+        # BaseUpdateProcessor.process_update takes its semaphore before
+        # do_process_update, that is before the turn of the chat, so it is
+        # made too wide to ever wait and the slots are taken here instead
+        super().__init__(sys.maxsize)
+        self.slots = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._busy = 0
+        self._chat_locks = {}
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        # Only the updates holding a slot, not the ones waiting for their chat
+        return self._busy
+
+    async def _run(self, coroutine) -> None:
+        async with self._slots:
+            self._busy += 1
+            try:
+                await coroutine
+            finally:
+                self._busy -= 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        if chat_id is None:
+            await self._run(coroutine)
+            return
+        lock, waiters = self._chat_locks.get(chat_id, (asyncio.Lock(), 0))
+        self._chat_locks[chat_id] = (lock, waiters + 1)
+        try:
+            async with lock:
+                await self._run(coroutine)
+        finally:
+            lock, waiters = self._chat_locks[chat_id]
+            if waiters == 1:
+                del self._chat_locks[chat_id]
+            else:
+                self._chat_locks[chat_id] = (lock, waiters - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import subprocess
+import sys
+from pathlib import Path
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from functions.env import load_env
+from functions.credits import credits_spool_path
+from functions.jobs import job_queue_path
+from functions.metrics import metrics_port
+
+load_env()
+webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+webhook_port = int(os.getenv("WEBHOOK_PORT", "8080"))
+webhook_path = os.getenv("WEBHOOK_PATH", "/telegram")
+# Public URL registered with Telegram. Leave it empty on workers behind a router.
+webhook_url = os.getenv("WEBHOOK_URL", "")
+webhook_secret_token = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+# The router forwards to WEBHOOK_WORKER_URLS, or spawns WEBHOOK_WORKERS local
+# worker processes on the ports that follow WEBHOOK_PORT when it is empty.
+webhook_workers = int(os.getenv("WEBHOOK_WORKERS", "2"))
+webhook_worker_urls = [url for url in os.getenv("WEBHOOK_WORKER_URLS", "").split(",") if url]
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger(__name__)
+
+
+def chat_id_of(data: dict):
+    # Raw JSON version, used by the router without building an Update
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+    return data.get("update_id")
+
+
+def pick_worker(key, workers: list) -> str:
+    # Rendezvous hashing: a chat always lands on the same worker, and adding
+    # or removing a worker only moves the chats of that worker.
+    return max(
+        workers,
+        key=lambda worker: hashlib.blake2b(f"{key}:{worker}".encode(), digest_size=8).digest(),
+    )
+
+
+def is_authorized(request: web.Request) -> bool:
+    # run_webhook refuses to start without a secret: updates carry the user
+    # whose saved session (and phone) handles them, so anyone able to post
+    # one could act as any user
+    secret = request.headers.get(SECRET_HEADER, "")
+    return bool(webhook_secret_token) and hmac.compare_digest(secret.encode(), webhook_secret_token.encode())
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+
+def create_worker_app(application: Application) -> web.Application:
+    async def receive_update(request: web.Request) -> web.Response:
+        if not is_authorized(request):
+            return web.Response(status=403)
+        data = await request.json()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def on_startup(app: web.Application) -> None:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=webhook_secret_token or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+    async def on_cleanup(app: web.Application) -> None:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    app = web.Application()
+    app.router.add_post(webhook_path, receive_update)
+    app.router.add_get("/healthz", health)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def worker_path(path: str, index: int) -> str:
+    # jobs.sqlite3 -> jobs-1.sqlite3 for the first worker
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}-{index}{path.suffix}"))
+
+
+def create_router_app(application: Application, script: str) -> web.Application:
+    processes = []
+    workers = list(webhook_worker_urls)
+    if not workers:
+        workers = [
+            f"http://127.0.0.1:{webhook_port + index}{webhook_path}"
+            for index in range(1, webhook_workers + 1)
+        ]
+
+    async def forward_update(request: web.Request) -> web.Response:
+        if not is_authorized(request):
+            return web.Response(status=403)
+        body = await request.read()
+        worker = pick_worker(chat_id_of(json.loads(body)), workers)
+        try:
+            async with request.app["session"].post(worker, data=body, headers={SECRET_HEADER: webhook_secret_token}) as response:
+                return web.Response(status=response.status)
+        except aiohttp.ClientError as e:
+            logger.warning("Error al reenviar la actualización a %s: %s", worker, e)
+            # A non-2xx answer makes Telegram deliver the update again
+            return web.Response(status=502)
+
+    async def on_startup(app: web.Application) -> None:
+        if not webhook_worker_urls:
+            for index in range(1, webhook_workers + 1):
+                # Each worker resumes its own pending receipts after a restart
+                # and spools its own credits: the spool is rewritten whole,
+                # so two processes sharing it would lose and repeat rows
+                env = {
+                    **os.environ,
+                    "BOT_MODE": "webhook",
+                    "WEBHOOK_ROLE": "worker",
+                    "WEBHOOK_HOST": "127.0.0.1",
+                    "WEBHOOK_PORT": str(webhook_port + index),
+                    "WEBHOOK_URL": "",
+                    "JOB_QUEUE_PATH": worker_path(job_queue_path, index),
+                    "CREDITS_SPOOL_PATH": worker_path(credits_spool_path, index),
+                    "METRICS_PORT": str(metrics_port + index if metrics_port else 0),
+                }
+                processes.append(subprocess.Popen([sys.executable, script], env=env))
+        app["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        if webhook_url:
+            async with application:
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=webhook_secret_token,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+
+    async def on_cleanup(app: web.Application) -> None:
+        await app["session"].close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.wait)
+
+    app = web.Application()
+    app.router.add_post(webhook_path, forward_update)
+    app.router.add_get("/healthz", health)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_webhook(application: Application, role: str, script: str) -> None:
+    if not webhook_secret_token:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET_TOKEN")
+    if role == "router":
+        app = create_router_app(application, script)
+    else:
+        app = create_worker_app(application)
+    web.run_app(app, host=webhook_host, port=webhook_port)
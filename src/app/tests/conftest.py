@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The bot imports its modules as functions.*, from src/app
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
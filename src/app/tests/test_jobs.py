@@ -0,0 +1,119 @@
+import asyncio
+import time
+import pytest
+from functions.jobs import DurableQueue, QueueFull, RetryLater, UserQueueFull
+
+
+def queue(tmp_path, **overrides) -> DurableQueue:
+    options = {
+        "max_pending": 100,
+        "max_pending_per_user": 50,
+        "max_attempts": 3,
+        "backoff_base": 2,
+        "backoff_max": 60,
+    }
+    return DurableQueue(path=str(tmp_path / "jobs.sqlite3"), **{**options, **overrides})
+
+
+def claim_all(jobs: DurableQueue) -> list:
+    # Claims without completing, as busy workers would
+    claimed = []
+    while (job := jobs.claim()) is not None:
+        claimed.append(job[1]["user"])
+    return claimed
+
+
+def test_claim_takes_turns_by_user(tmp_path):
+    jobs = queue(tmp_path)
+    for user_id, count in (("a", 4), ("b", 2), ("c", 1)):
+        for _ in range(count):
+            jobs.enqueue({"user": user_id}, user_id=user_id)
+    assert claim_all(jobs) == ["a", "b", "c", "a", "b", "a", "a"]
+
+
+def test_claim_goes_first_to_the_oldest_without_user(tmp_path):
+    # Jobs queued before they had a user are claimed like any other user's
+    jobs = queue(tmp_path)
+    jobs.enqueue({"user": None})
+    for user_id in ("a", "a", "b"):
+        jobs.enqueue({"user": user_id}, user_id=user_id)
+    assert claim_all(jobs) == [None, "a", "b", "a"]
+
+
+def test_enqueue_caps_the_jobs_of_a_user(tmp_path):
+    jobs = queue(tmp_path, max_pending_per_user=3)
+    ids = [jobs.enqueue({"user": "a"}, user_id="a") for _ in range(3)]
+    with pytest.raises(UserQueueFull):
+        jobs.enqueue({"user": "a"}, user_id="a")
+    # Other users are not affected, and a finished job frees its place
+    jobs.enqueue({"user": "b"}, user_id="b")
+    job_id, _, _ = jobs.claim()
+    assert job_id == ids[0]
+    jobs.complete(job_id)
+    jobs.enqueue({"user": "a"}, user_id="a")
+
+
+def test_enqueue_caps_the_whole_queue(tmp_path):
+    jobs = queue(tmp_path, max_pending=2)
+    jobs.enqueue({"user": "a"}, user_id="a")
+    jobs.enqueue({"user": "b"}, user_id="b")
+    with pytest.raises(QueueFull):
+        jobs.enqueue({"user": "c"}, user_id="c")
+
+
+def test_failed_jobs_back_off_and_die(tmp_path):
+    jobs = queue(tmp_path, max_attempts=2)
+    jobs.enqueue({"user": "a"}, user_id="a")
+    job_id, _, attempts = jobs.claim()
+    assert not jobs.fail(job_id, attempts, "error")
+    # Waiting for its backoff
+    assert jobs.claim() is None
+    jobs._execute("UPDATE jobs SET available_at = ?", (time.time(),))
+    job_id, _, attempts = jobs.claim()
+    assert attempts == 2
+    assert jobs.fail(job_id, attempts, "error")
+    assert jobs.counts() == {"dead": 1}
+
+
+def test_postponed_jobs_keep_their_attempts(tmp_path):
+    jobs = queue(tmp_path)
+    jobs.enqueue({"user": "a"}, user_id="a")
+    job_id, _, attempts = jobs.claim()
+    jobs.postpone(job_id, 30, "busy")
+    assert jobs.claim() is None
+    (available_at,), = jobs._execute("SELECT available_at FROM jobs")
+    assert available_at > time.time() + 25
+    jobs._execute("UPDATE jobs SET available_at = ?", (time.time(),))
+    assert jobs.claim()[2] == attempts
+
+
+def test_recover_puts_running_jobs_back(tmp_path):
+    jobs = queue(tmp_path)
+    jobs.enqueue({"user": "a"}, user_id="a")
+    jobs.claim()
+    assert jobs.recover() == 1
+    assert jobs.counts() == {"pending": 1}
+
+
+def test_workers_postpone_on_retry_later(tmp_path):
+    jobs = queue(tmp_path, max_attempts=1)
+    runs = []
+
+    async def handler(payload):
+        runs.append(payload)
+        if len(runs) < 3:
+            raise RetryLater(0)
+
+    async def main():
+        await jobs.put({"user": "a"}, user_id="a")
+        await jobs.start(handler, workers=1, poll_interval=0.01)
+        for _ in range(200):
+            if not jobs.counts():
+                break
+            await asyncio.sleep(0.01)
+        await jobs.stop()
+
+    asyncio.run(main())
+    # With a single attempt, a failure instead would have killed the job
+    assert len(runs) == 3
+    assert jobs.counts() == {}
@@ -0,0 +1,154 @@
+import asyncio
+import pytest
+from google.genai import errors
+from functions.quota import GeminiBusy, GeminiScheduler
+
+
+def scheduler(**overrides) -> GeminiScheduler:
+    options = {
+        "rpm": 6000,
+        "tpm": 10_000_000,
+        "max_concurrent": 8,
+        "user_max_in_flight": 2,
+        "max_wait": 1,
+        "estimated_tokens": 100,
+        "max_retries": 3,
+        "backoff_base": 0.01,
+        "backoff_max": 0.05,
+        "hedge": False,
+        "hedge_min_delay": 5,
+    }
+    return GeminiScheduler(**{**options, **overrides})
+
+
+def usage(tokens: int = 100) -> dict:
+    return {
+        "input": {"token_text": tokens, "token_image": 0, "token_cached": 0},
+        "output": {"token_text": 0},
+    }
+
+
+def assert_idle(gemini: GeminiScheduler) -> None:
+    # Every slot taken was given back
+    assert gemini._running == 0
+    assert gemini.waiting() == 0
+    assert not gemini._in_flight
+    assert not gemini._users
+
+
+def test_own_calls_do_not_count_against_max_wait():
+    # 10 photos of one album take 5 rounds of 0.3s with 2 in flight, longer
+    # than max_wait, and none of them is turned away
+    gemini = scheduler(max_wait=0.5)
+    running = 0
+    most = 0
+
+    async def call():
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.3)
+        running -= 1
+        return usage()
+
+    async def main():
+        return await asyncio.gather(*(gemini.run("a", call) for _ in range(10)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert not [result for result in results if isinstance(result, BaseException)]
+    assert most == 2
+    assert_idle(gemini)
+
+
+def test_users_take_turns():
+    gemini = scheduler(max_concurrent=1, user_max_in_flight=1, max_wait=10)
+    order = []
+
+    def call(user_id):
+        async def run():
+            order.append(user_id)
+            await asyncio.sleep(0.01)
+            return usage()
+        return run
+
+    async def main():
+        calls = [gemini.run("a", call("a")) for _ in range(4)]
+        calls += [gemini.run("b", call("b")) for _ in range(2)]
+        await asyncio.gather(*calls)
+
+    asyncio.run(main())
+    assert order == ["a", "b", "a", "b", "a", "a"]
+    assert_idle(gemini)
+
+
+def test_busy_when_the_quota_wait_is_too_long():
+    # One request per minute: the second call would wait about a minute
+    gemini = scheduler(rpm=1, max_wait=1)
+
+    async def call():
+        return usage()
+
+    async def main():
+        await gemini.run("a", call)
+        with pytest.raises(GeminiBusy) as busy:
+            await gemini.run("b", call)
+        return busy.value
+
+    busy = asyncio.run(main())
+    assert busy.wait > 1
+    assert_idle(gemini)
+
+
+def test_cancelled_waiters_give_back_their_turn():
+    gemini = scheduler(max_concurrent=1, max_wait=10)
+
+    async def main():
+        done = asyncio.Event()
+
+        async def slow():
+            await done.wait()
+            return usage()
+
+        first = asyncio.create_task(gemini.run("a", slow))
+        waiting = [asyncio.create_task(gemini.run(user_id, slow)) for user_id in ("a", "a", "b")]
+        await asyncio.sleep(0.05)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        done.set()
+        await first
+
+    asyncio.run(main())
+    assert_idle(gemini)
+
+
+def test_throttled_calls_are_retried():
+    gemini = scheduler()
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise errors.ClientError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+        return usage()
+
+    result = asyncio.run(gemini.run("a", call))
+    assert result == usage()
+    assert attempts == 3
+    assert_idle(gemini)
+
+
+def test_other_errors_are_not_retried():
+    gemini = scheduler()
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        raise errors.ClientError(400, {"error": {"code": 400, "message": "bad image", "status": "INVALID_ARGUMENT"}})
+
+    with pytest.raises(errors.ClientError):
+        asyncio.run(gemini.run("a", call))
+    assert attempts == 1
+    assert_idle(gemini)
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from telegram import Update
+from functions.updates import ChatOrderedUpdateProcessor
+
+
+def update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hola"},
+        },
+        None,
+    )
+
+
+def test_a_busy_chat_does_not_stall_the_others():
+    # 64 slow updates of one chat and one update of each of 8 other chats,
+    # with 4 slots: the busy chat runs one at a time, in order, and holds a
+    # single slot, so the other chats finish right away
+    processor = ChatOrderedUpdateProcessor(4)
+    finished = {}
+    order = []
+    running = 0
+    most = 0
+
+    async def handle(update_id: int, chat_id: int, seconds: float) -> None:
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(seconds)
+        running -= 1
+        order.append((chat_id, update_id))
+        finished[update_id] = time.monotonic()
+
+    async def main():
+        start = time.monotonic()
+        tasks = [
+            asyncio.create_task(processor.process_update(update(update_id, 1), handle(update_id, 1, 0.02)))
+            for update_id in range(64)
+        ]
+        tasks += [
+            asyncio.create_task(processor.process_update(update(100 + chat_id, chat_id), handle(100 + chat_id, chat_id, 0.02)))
+            for chat_id in range(2, 10)
+        ]
+        await asyncio.gather(*tasks)
+        return start
+
+    start = asyncio.run(main())
+    others = [finished[100 + chat_id] - start for chat_id in range(2, 10)]
+    assert max(others) < 0.5
+    assert [update_id for chat_id, update_id in order if chat_id == 1] == list(range(64))
+    assert most <= 4
+    assert processor.current_concurrent_updates == 0
+    assert not processor._chat_locks
+
+
+def test_updates_without_chat_take_a_slot():
+    processor = ChatOrderedUpdateProcessor(2)
+    running = 0
+    most = 0
+
+    async def handle() -> None:
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        await asyncio.gather(*(processor.process_update(object(), handle()) for _ in range(6)))
+
+    asyncio.run(main())
+    assert most == 2
+    assert processor.current_concurrent_updates == 0
+
+
+def test_a_failed_update_releases_its_chat():
+    processor = ChatOrderedUpdateProcessor(1)
+    handled = []
+
+    async def fail() -> None:
+        raise ValueError("boom")
+
+    async def handle() -> None:
+        handled.append(True)
+
+    async def main():
+        results = await asyncio.gather(
+            processor.process_update(update(1, 1), fail()),
+            processor.process_update(update(2, 1), handle()),
+            return_exceptions=True,
+        )
+        return results
+
+    results = asyncio.run(main())
+    assert isinstance(results[0], ValueError)
+    assert handled == [True]
+    assert processor.current_concurrent_updates == 0
+    assert not processor._chat_locks
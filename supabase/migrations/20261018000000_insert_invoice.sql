@@ -0,0 +1,73 @@
+-- Writes the header, the products and the token usage of a receipt in a
+-- single round trip. The function body runs in one transaction, so either
+-- every row is stored or none of them is.
+create or replace function public.insert_invoice(
+    p_invoice jsonb,
+    p_details jsonb,
+    p_credits jsonb default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_invoice_id bigint;
+    v_detail_ids bigint[];
+    v_credits_id bigint;
+begin
+    insert into public.invoices (
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file
+    )
+    select
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file
+    from jsonb_populate_record(null::public.invoices, p_invoice)
+    returning id into v_invoice_id;
+
+    with inserted as (
+        insert into public.invoices_detail (id_invoice, product_name, unit_price, quantity)
+        select id_invoice, product_name, unit_price, quantity
+        from jsonb_populate_recordset(null::public.invoices_detail, coalesce(p_details, '[]'::jsonb))
+        returning id
+    )
+    select coalesce(array_agg(id), '{}') into v_detail_ids from inserted;
+
+    if p_credits is not null then
+        insert into public.user_credits (user_id, input_token_text, input_token_image, output_token_text)
+        select user_id, input_token_text, input_token_image, output_token_text
+        from jsonb_populate_record(null::public.user_credits, p_credits)
+        returning id into v_credits_id;
+    end if;
+
+    return jsonb_build_object(
+        'invoice', v_invoice_id,
+        'details', to_jsonb(v_detail_ids),
+        'credits', v_credits_id
+    );
+end;
+$$;
+
+-- Undoes insert_invoice with the ids it returned. Used when the image upload
+-- that runs next to it fails, so no invoice is left without its file.
+create or replace function public.delete_invoice(p_ids jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    delete from public.invoices_detail
+    where id in (select jsonb_array_elements_text(p_ids -> 'details')::bigint);
+    delete from public.user_credits
+    where id = (p_ids ->> 'credits')::bigint;
+    delete from public.invoices
+    where id = (p_ids ->> 'invoice')::bigint;
+end;
+$$;
+
+grant execute on function public.insert_invoice(jsonb, jsonb, jsonb) to anon, authenticated;
+grant execute on function public.delete_invoice(jsonb) to anon, authenticated;
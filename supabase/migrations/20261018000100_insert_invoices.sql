@@ -0,0 +1,37 @@
+-- Batch version of insert_invoice for albums: every receipt of the array is
+-- stored in the same transaction, so the batch is written whole or not at all.
+-- Each item is an object with the "invoice", "details" and "credits" keys
+-- that insert_invoice receives as arguments.
+create or replace function public.insert_invoices(p_invoices jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+    v_ids jsonb := '[]'::jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_invoices) loop
+        v_ids := v_ids || jsonb_build_array(
+            public.insert_invoice(v_item -> 'invoice', v_item -> 'details', nullif(v_item -> 'credits', 'null'::jsonb))
+        );
+    end loop;
+    return v_ids;
+end;
+$$;
+
+-- Undoes insert_invoices with the array of ids it returned.
+create or replace function public.delete_invoices(p_ids jsonb)
+returns void
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_ids) loop
+        perform public.delete_invoice(v_item);
+    end loop;
+end;
+$$;
+
+grant execute on function public.insert_invoices(jsonb) to anon, authenticated;
+grant execute on function public.delete_invoices(jsonb) to anon, authenticated;
@@ -0,0 +1,48 @@
+-- delete_invoice and delete_invoices took any ids, and with row level
+-- security they could delete nothing without an error. They now take the
+-- user the rows belong to, only delete that user's rows and raise when the
+-- invoice is not there, so a failed undo is never taken for a done one.
+drop function if exists public.delete_invoices(jsonb);
+drop function if exists public.delete_invoice(jsonb);
+
+create or replace function public.delete_invoice(p_user_id text, p_ids jsonb)
+returns void
+language plpgsql
+as $$
+declare
+    v_number text;
+begin
+    delete from public.invoices
+    where id = (p_ids ->> 'invoice')::bigint
+      and user_id::text = p_user_id
+    returning id_invoice into v_number;
+    if not found then
+        raise exception 'Invoice % of user % not found', p_ids ->> 'invoice', p_user_id
+            using errcode = 'no_data_found';
+    end if;
+    -- Only the products of the invoice just deleted
+    delete from public.invoices_detail
+    where id in (select jsonb_array_elements_text(p_ids -> 'details')::bigint)
+      and id_invoice = v_number;
+    delete from public.user_credits
+    where id = (p_ids ->> 'credits')::bigint
+      and user_id::text = p_user_id;
+end;
+$$;
+
+-- Undoes insert_invoices with the array of ids it returned, all or nothing
+create or replace function public.delete_invoices(p_user_id text, p_ids jsonb)
+returns void
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_ids) loop
+        perform public.delete_invoice(p_user_id, v_item);
+    end loop;
+end;
+$$;
+
+grant execute on function public.delete_invoice(text, jsonb) to anon, authenticated;
+grant execute on function public.delete_invoices(text, jsonb) to anon, authenticated;
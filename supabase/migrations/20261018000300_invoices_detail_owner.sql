@@ -0,0 +1,93 @@
+-- Products pointed to their invoice only by its number, which repeats
+-- across stores and users. invoices_detail.invoice is the id of the invoice
+-- row they belong to, so reading the products of a user's invoices never
+-- brings another user's. Deleting an invoice also deletes its products.
+alter table public.invoices_detail
+    add column if not exists invoice bigint references public.invoices (id) on delete cascade;
+
+create index if not exists invoices_detail_invoice_id_idx
+    on public.invoices_detail (invoice, id);
+
+-- Existing products are only linked when a single invoice has their number.
+-- The rest stay without an owner and are left out of exports.
+update public.invoices_detail as detail
+set invoice = owner.id
+from (
+    select id_invoice, min(id) as id
+    from public.invoices
+    group by id_invoice
+    having count(*) = 1
+) as owner
+where detail.invoice is null
+  and detail.id_invoice = owner.id_invoice;
+
+create or replace function public.insert_invoice(
+    p_invoice jsonb,
+    p_details jsonb,
+    p_credits jsonb default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_invoice_id bigint;
+    v_detail_ids bigint[];
+    v_credits_id bigint;
+begin
+    insert into public.invoices (
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file
+    )
+    select
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file
+    from jsonb_populate_record(null::public.invoices, p_invoice)
+    returning id into v_invoice_id;
+
+    with inserted as (
+        insert into public.invoices_detail (invoice, id_invoice, product_name, unit_price, quantity)
+        select v_invoice_id, id_invoice, product_name, unit_price, quantity
+        from jsonb_populate_recordset(null::public.invoices_detail, coalesce(p_details, '[]'::jsonb))
+        returning id
+    )
+    select coalesce(array_agg(id), '{}') into v_detail_ids from inserted;
+
+    if p_credits is not null then
+        insert into public.user_credits (user_id, input_token_text, input_token_image, output_token_text)
+        select user_id, input_token_text, input_token_image, output_token_text
+        from jsonb_populate_record(null::public.user_credits, p_credits)
+        returning id into v_credits_id;
+    end if;
+
+    return jsonb_build_object(
+        'invoice', v_invoice_id,
+        'details', to_jsonb(v_detail_ids),
+        'credits', v_credits_id
+    );
+end;
+$$;
+
+create or replace function public.delete_invoice(p_user_id text, p_ids jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    -- The products go with the invoice (on delete cascade)
+    delete from public.invoices
+    where id = (p_ids ->> 'invoice')::bigint
+      and user_id::text = p_user_id;
+    if not found then
+        raise exception 'Invoice % of user % not found', p_ids ->> 'invoice', p_user_id
+            using errcode = 'no_data_found';
+    end if;
+    delete from public.user_credits
+    where id = (p_ids ->> 'credits')::bigint
+      and user_id::text = p_user_id;
+end;
+$$;
@@ -0,0 +1,109 @@
+-- A receipt job can run more than once: the RPC may commit while the client
+-- times out, or the bot may stop between saving and finishing the job.
+-- invoices.idempotency_key identifies the receipt of a job, and
+-- insert_invoice called again with the same key returns the ids of the rows
+-- already stored instead of inserting them twice.
+alter table public.invoices
+    add column if not exists idempotency_key text;
+
+create unique index if not exists invoices_user_id_idempotency_key_idx
+    on public.invoices (user_id, idempotency_key);
+
+drop function if exists public.insert_invoices(jsonb);
+drop function if exists public.insert_invoice(jsonb, jsonb, jsonb);
+
+create or replace function public.insert_invoice(
+    p_invoice jsonb,
+    p_details jsonb,
+    p_credits jsonb default null,
+    p_key text default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_invoice_id bigint;
+    v_detail_ids bigint[];
+    v_credits_id bigint;
+begin
+    insert into public.invoices (
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file, idempotency_key
+    )
+    select
+        user_id, id_invoice, payment_date, date, time, payment_method,
+        currency_type, category_type, id_seller, name_seller, id_client,
+        name_client, address, total, recorded_operation, igv, isc,
+        unaffected, exonerated, export, free, discount, others_charge,
+        others_taxes, path_file, p_key
+    from jsonb_populate_record(null::public.invoices, p_invoice)
+    on conflict (user_id, idempotency_key) do nothing
+    returning id into v_invoice_id;
+
+    if v_invoice_id is null then
+        -- Stored by an earlier run of the same job: nothing is written again
+        select id into v_invoice_id
+        from public.invoices
+        where user_id::text = p_invoice ->> 'user_id'
+          and idempotency_key = p_key;
+        select coalesce(array_agg(id order by id), '{}') into v_detail_ids
+        from public.invoices_detail
+        where invoice = v_invoice_id;
+        return jsonb_build_object(
+            'invoice', v_invoice_id,
+            'details', to_jsonb(v_detail_ids),
+            'credits', null
+        );
+    end if;
+
+    with inserted as (
+        insert into public.invoices_detail (invoice, id_invoice, product_name, unit_price, quantity)
+        select v_invoice_id, id_invoice, product_name, unit_price, quantity
+        from jsonb_populate_recordset(null::public.invoices_detail, coalesce(p_details, '[]'::jsonb))
+        returning id
+    )
+    select coalesce(array_agg(id), '{}') into v_detail_ids from inserted;
+
+    if p_credits is not null then
+        insert into public.user_credits (user_id, input_token_text, input_token_image, output_token_text)
+        select user_id, input_token_text, input_token_image, output_token_text
+        from jsonb_populate_record(null::public.user_credits, p_credits)
+        returning id into v_credits_id;
+    end if;
+
+    return jsonb_build_object(
+        'invoice', v_invoice_id,
+        'details', to_jsonb(v_detail_ids),
+        'credits', v_credits_id
+    );
+end;
+$$;
+
+-- Each item may also have a "key", the idempotency key of its receipt
+create or replace function public.insert_invoices(p_invoices jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+    v_ids jsonb := '[]'::jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_invoices) loop
+        v_ids := v_ids || jsonb_build_array(
+            public.insert_invoice(
+                v_item -> 'invoice',
+                v_item -> 'details',
+                nullif(v_item -> 'credits', 'null'::jsonb),
+                v_item ->> 'key'
+            )
+        );
+    end loop;
+    return v_ids;
+end;
+$$;
+
+grant execute on function public.insert_invoice(jsonb, jsonb, jsonb, text) to anon, authenticated;
+grant execute on function public.insert_invoices(jsonb) to anon, authenticated;
@@ -0,0 +1,102 @@
+-- The bot only saves and undoes receipts through insert_invoices and
+-- delete_invoices. insert_invoice and delete_invoice were callable on their
+-- own by anon as a second write path, so their bodies move into the batch
+-- functions and they are dropped.
+create or replace function public.insert_invoices(p_invoices jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+    v_key text;
+    v_invoice_id bigint;
+    v_detail_ids bigint[];
+    v_credits_id bigint;
+    v_ids jsonb := '[]'::jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_invoices) loop
+        v_key := v_item ->> 'key';
+        v_credits_id := null;
+
+        insert into public.invoices (
+            user_id, id_invoice, payment_date, date, time, payment_method,
+            currency_type, category_type, id_seller, name_seller, id_client,
+            name_client, address, total, recorded_operation, igv, isc,
+            unaffected, exonerated, export, free, discount, others_charge,
+            others_taxes, path_file, idempotency_key
+        )
+        select
+            user_id, id_invoice, payment_date, date, time, payment_method,
+            currency_type, category_type, id_seller, name_seller, id_client,
+            name_client, address, total, recorded_operation, igv, isc,
+            unaffected, exonerated, export, free, discount, others_charge,
+            others_taxes, path_file, v_key
+        from jsonb_populate_record(null::public.invoices, v_item -> 'invoice')
+        on conflict (user_id, idempotency_key) do nothing
+        returning id into v_invoice_id;
+
+        if v_invoice_id is null then
+            -- Stored by an earlier run of the same job: nothing is written again
+            select id into v_invoice_id
+            from public.invoices
+            where user_id::text = v_item -> 'invoice' ->> 'user_id'
+              and idempotency_key = v_key;
+            select coalesce(array_agg(id order by id), '{}') into v_detail_ids
+            from public.invoices_detail
+            where invoice = v_invoice_id;
+        else
+            with inserted as (
+                insert into public.invoices_detail (invoice, id_invoice, product_name, unit_price, quantity)
+                select v_invoice_id, id_invoice, product_name, unit_price, quantity
+                from jsonb_populate_recordset(
+                    null::public.invoices_detail,
+                    coalesce(nullif(v_item -> 'details', 'null'::jsonb), '[]'::jsonb)
+                )
+                returning id
+            )
+            select coalesce(array_agg(id), '{}') into v_detail_ids from inserted;
+
+            if nullif(v_item -> 'credits', 'null'::jsonb) is not null then
+                insert into public.user_credits (user_id, input_token_text, input_token_image, output_token_text)
+                select user_id, input_token_text, input_token_image, output_token_text
+                from jsonb_populate_record(null::public.user_credits, v_item -> 'credits')
+                returning id into v_credits_id;
+            end if;
+        end if;
+
+        v_ids := v_ids || jsonb_build_array(jsonb_build_object(
+            'invoice', v_invoice_id,
+            'details', to_jsonb(v_detail_ids),
+            'credits', v_credits_id
+        ));
+    end loop;
+    return v_ids;
+end;
+$$;
+
+-- Undoes insert_invoices with the array of ids it returned, all or nothing
+create or replace function public.delete_invoices(p_user_id text, p_ids jsonb)
+returns void
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+begin
+    for v_item in select * from jsonb_array_elements(p_ids) loop
+        -- The products go with the invoice (on delete cascade)
+        delete from public.invoices
+        where id = (v_item ->> 'invoice')::bigint
+          and user_id::text = p_user_id;
+        if not found then
+            raise exception 'Invoice % of user % not found', v_item ->> 'invoice', p_user_id
+                using errcode = 'no_data_found';
+        end if;
+        delete from public.user_credits
+        where id = (v_item ->> 'credits')::bigint
+          and user_id::text = p_user_id;
+    end loop;
+end;
+$$;
+
+drop function if exists public.insert_invoice(jsonb, jsonb, jsonb, text);
+drop function if exists public.delete_invoice(text, jsonb);